@@ -3,9 +3,11 @@
 ckan.module('autocomplete-ogdzh-facet-search', function ($) {
   return {
     initialize: function () {
+        var selector = 'input#ogdzh_search[name="q"]';
         new autoComplete({
-            selector: 'input#ogdzh_search[name="q"]',
+            selector: selector,
             minChars: 2,
+            delay: ogdzhSuggestSource.delay,
             renderItem: function (item, search){
                 // put some searches in quotes, so that solr does not interpret special characters
                 if (item.match(/\s/g)) {
@@ -14,8 +16,7 @@ ckan.module('autocomplete-ogdzh-facet-search', function ($) {
                 return '<div class="autocomplete-suggestion" data-val="' + item.replace(/"/g, '&quot;') + '">' + item + '</div>';
             },
             source: function(term, response){
-                var url = '/api/3/action/ogdzh_autosuggest';
-                var params = {q: term};
+                var cfq = '';
                 // check if any filters/facets are set and send them along
                 var values = [];
                 $("#dataset-search-form input[name='groups']").each(function (elem) {
@@ -32,12 +33,9 @@ ckan.module('autocomplete-ogdzh-facet-search', function ($) {
                 });
                 if (values) {
                     values = values.map(function(v) { return v.replace(/-/gi, ''); });
-                    params.cfq = values.join(' AND ');
+                    cfq = values.join(' AND ');
                 }
-                $.getJSON('/api/3/action/ogdzh_autosuggest', params)
-                .done(function(data){
-                    response(data.result);
-                });
+                ogdzhSuggestSource.load(term, cfq, selector, response);
             }
         });
     }
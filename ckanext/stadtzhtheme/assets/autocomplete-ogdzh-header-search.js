@@ -3,9 +3,11 @@
 ckan.module('autocomplete-ogdzh-header-search', function ($) {
   return {
     initialize: function () {
+        var selector = 'input#field-sitewide-search[name="q"]';
         new autoComplete({
-            selector: 'input#field-sitewide-search[name="q"]',
+            selector: selector,
             minChars: 2,
+            delay: ogdzhSuggestSource.delay,
             renderItem: function (item, search){
                 // put some searches in quotes, so that solr does not interpret special characters
                 if (item.match(/\s/g)) {
@@ -14,12 +16,7 @@ ckan.module('autocomplete-ogdzh-header-search', function ($) {
                 return '<div class="autocomplete-suggestion" data-val="' + item.replace(/"/g, '&quot;') + '">' + item + '</div>';
             },
             source: function(term, response){
-                var url = '/api/3/action/ogdzh_autosuggest';
-                var params = {q: term};
-                $.getJSON('/api/3/action/ogdzh_autosuggest', params)
-                .done(function(data){
-                    response(data.result);
-                });
+                ogdzhSuggestSource.load(term, '', selector, response);
             }
         });
     }
@@ -0,0 +1,38 @@
+"use strict";
+
+// Shared source for the ogdzh autocomplete modules. Requests go to the
+// cacheable suggest endpoint and a request that is still running when the
+// next one starts is aborted. Caching the answers per search term (and
+// skipping terms whose prefix had none) is left to autoComplete.
+var ogdzhSuggestSource = (function ($) {
+  var pending = null;
+
+  return {
+    // debounce: autoComplete waits this long (ms) after the last keystroke
+    delay: 250,
+    load: function (term, cfq, input, response) {
+      if (pending) {
+        pending.abort();
+        pending = null;
+      }
+
+      var params = {q: term};
+      if (cfq) {
+        params.cfq = cfq;
+      }
+      var request = $.getJSON('/api/ogdzh/suggest', params);
+      pending = request;
+      request.done(function (data) {
+        // autoComplete shows (and caches) the data for the current value of
+        // the input, which may have changed, e.g. to a cached shorter term
+        if ($(input).val() === term) {
+          response(data);
+        }
+      }).always(function () {
+        if (pending === request) {
+          pending = null;
+        }
+      });
+    }
+  };
+})(jQuery);
@@ -1,22 +1,67 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
 from typing import Optional, Union
+from urllib.parse import quote
 
 import ckan.lib.base as base
-import ckan.lib.helpers as h
 import ckan.lib.uploader as uploader
 import ckan.logic as logic
 from ckan.common import _, current_user
 from ckan.lib import munge, signals
 from ckan.plugins import toolkit as tk
 from ckan.types import Context, Response
-from flask import Blueprint, send_file
+from dateutil.parser import isoparse
+from flask import Blueprint
+from flask import Response as FlaskResponse
+from flask import make_response, request, send_file
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import parse_cache_control_header
+from werkzeug.utils import redirect
+from werkzeug.utils import send_file as werkzeug_send_file
 from werkzeug.wrappers.response import Response as WerkzeugResponse
 
+from ckanext.stadtzhtheme import downloads, jobs
+from ckanext.stadtzhtheme import logic as ogdzh_logic
+from ckanext.stadtzhtheme import storage
+from ckanext.stadtzhtheme.cache import (
+    RESOURCE_PERMALINK_CACHE,
+    invalidate_cache,
+    permalink_resources,
+)
+
 get_action = logic.get_action
 NotFound = logic.NotFound
 NotAuthorized = logic.NotAuthorized
 abort = tk.abort
 
 ogdzh_dataset = Blueprint("ogdzh_dataset", __name__, url_prefix="/dataset")
+ogdzh_api = Blueprint("ogdzh_api", __name__, url_prefix="/api/ogdzh")
+
+
+class CachedResponse(FlaskResponse):
+    """A response with a fixed Cache-Control header.
+
+    CKAN sets the Cache-Control header of every response after the view has
+    run, with the max-age of `ckan.cache_expires`. Once it is set with
+    `set_cache_control`, the header of this response is not changed anymore.
+    """
+
+    _fixed_cache_control = False
+
+    def set_cache_control(self, value: str):
+        self.headers["Cache-Control"] = value
+        self._fixed_cache_control = True
+
+    @property
+    def cache_control(self) -> ResponseCacheControl:
+        if self._fixed_cache_control:
+            # changes to this object are not written back to the header
+            return parse_cache_control_header(
+                self.headers["Cache-Control"], cls=ResponseCacheControl
+            )
+        return super().cache_control
 
 
 def s3filestore_download(package_name: str, filename: str, resource_id: str):
@@ -39,43 +84,274 @@ def resource_download_permalink(
     will not change even if a resource is deleted and reuploaded with a new id.
     """
     context: Context = {"user": current_user.name, "auth_user_obj": current_user}
-    rsc = None
 
     try:
-        package = get_action("package_show")(context, {"id": package_name})
-        for res in package["resources"]:
-            # If the resource names match, this is the resource we want
-            if res["name"] == resource_name:
-                # Search for the resource using its id, to make sure it exists
-                rsc = get_action("resource_show")(context, {"id": res["id"]})
-                break
+        rsc = _get_permalink_resource(context, package_name, resource_name)
     except NotFound:
         return base.abort(404, _("Resource not found"))
     except NotAuthorized:
         return base.abort(403, _("Not authorized to download resource"))
 
-    if rsc.get("url_type") != "upload":
-        if "url" not in rsc:
-            return base.abort(404, _("No download is available"))
-        return h.redirect_to(rsc["url"])
+    if rsc.get("url_type") != "upload" and "url" not in rsc:
+        return base.abort(404, _("No download is available"))
+
+    url = _get_redirect_url(package_name, resource_name, rsc)
+    if url:
+        downloads.count_download(rsc["id"])
+        return _cached_redirect(url)
+    return _download_upload(rsc, resource_name)
 
-    if "s3filestore" in tk.config.get("ckan.plugins"):
-        # s3filestore needs the filename of the resource, which might be different
-        # from its name
+
+def _get_redirect_url(package_name: str, resource_name: str, rsc) -> Optional[str]:
+    """Return the URL a download is redirected to, or None if the upload is
+    sent.
+    """
+    if rsc.get("url_type") != "upload":
+        return rsc["url"]
+    if jobs.uses_s3filestore():
+        # s3filestore needs the filename of the resource, which might be
+        # different from its name
         resource_filename = rsc.get("filename", resource_name)
-        url = s3filestore_download(package_name, resource_filename, rsc.get("id"))
-        return h.redirect_to(url)
+        return s3filestore_download(package_name, resource_filename, rsc["id"])
+    return None
+
+
+def _cached_redirect(url: str) -> CachedResponse:
+    """Redirect to `url` with a response that may be cached for
+    `ckanext.stadtzhtheme.download_redirect_max_age` seconds (default 60), only
+    by the browser for logged-in users.
+    """
+    # flask.redirect ignores the response class
+    resp = redirect(url, Response=CachedResponse)
+    resp.set_cache_control(
+        "%s, max-age=%s"
+        % (
+            "private" if current_user.is_authenticated else "public",
+            tk.config.get("ckanext.stadtzhtheme.download_redirect_max_age", 60),
+        )
+    )
+    return resp
+
+
+def _download_upload(rsc, resource_name: str) -> WerkzeugResponse:
+    """Send an uploaded file, or one of its precompressed variants if the
+    client accepts it.
+    """
+    filepath = _get_upload_path(rsc)
+    precompressed = jobs.is_precompressed(rsc)
+    encoding = _get_content_encoding(filepath) if precompressed else None
+    etag, last_modified = _get_download_validators(rsc)
+    if etag and encoding:
+        etag = "%s-%s" % (etag, encoding)
 
-    upload = uploader.get_resource_uploader(rsc)
-    filepath = upload.get_path(rsc["id"])
-    resp = send_file(filepath, download_name=resource_name)
+    if _is_not_modified(etag, last_modified):
+        resp = make_response("", 304)
+        if etag:
+            resp.set_etag(etag)
+        resp.last_modified = last_modified
+    else:
+        if encoding:
+            filepath = storage.variant_path(filepath, encoding)
+        resp = _send_upload(filepath, resource_name, etag, last_modified)
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+        if rsc.get("mimetype"):
+            resp.headers["Content-Type"] = rsc["mimetype"]
+        signals.resource_download.send(resource_name)
+        if _is_first_part():
+            downloads.count_download(rsc["id"])
 
-    if rsc.get("mimetype"):
-        resp.headers["Content-Type"] = rsc["mimetype"]
-    signals.resource_download.send(resource_name)
+    if precompressed:
+        resp.vary.add("Accept-Encoding")
     return resp
 
 
+def _is_first_part() -> bool:
+    """Check if a download is counted: a full download, or a range request
+    starting at the beginning of the file. A client that fetches a file in
+    parts from the start is counted once, a resumed download is not counted.
+    """
+    return not request.range or request.range.ranges[0][0] == 0
+
+
+def _get_permalink_resource(context: Context, package_name: str, resource_name: str):
+    """Check that the user may see the package and look up a resource by its
+    name in the resource permalink cache.
+
+    The access is checked before the name is looked up, so users who may not
+    see a package can't tell which resource names it has. If the file of an
+    uploaded resource is missing, the resource might have been replaced by
+    another process, so it is looked up again.
+    """
+    tk.check_access("package_show", context, {"id": package_name})
+    rsc = _find_permalink_resource(package_name, resource_name)
+    if (
+        rsc.get("url_type") == "upload"
+        and not jobs.uses_s3filestore()
+        and not os.path.exists(_get_upload_path(rsc))
+    ):
+        invalidate_cache(RESOURCE_PERMALINK_CACHE, package_name)
+        rsc = _find_permalink_resource(package_name, resource_name)
+    return rsc
+
+
+def _find_permalink_resource(package_name: str, resource_name: str):
+    rsc = permalink_resources(package_name).get(resource_name)
+    if rsc is None:
+        raise NotFound(_("Resource not found"))
+    return rsc
+
+
+def _get_upload_path(rsc) -> str:
+    return uploader.get_resource_uploader(rsc).get_path(rsc["id"])
+
+
+def _get_download_validators(rsc):
+    """Return the ETag (the `zh_hash` or `hash` of the resource) and the last
+    modification date of an uploaded resource, both None if not available.
+    """
+    etag = rsc.get("zh_hash") or rsc.get("hash") or None
+    last_modified = None
+    if rsc.get("last_modified"):
+        try:
+            # unlike datetime.fromisoformat before Python 3.11, this accepts
+            # fractions of a second with any number of digits
+            last_modified = isoparse(rsc["last_modified"])
+        except ValueError:
+            pass
+        else:
+            # CKAN stores UTC timestamps, HTTP dates have a precision of seconds
+            if last_modified.tzinfo:
+                last_modified = last_modified.astimezone(timezone.utc)
+            last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    return etag, last_modified
+
+
+def _get_content_encoding(filepath: str) -> Optional[str]:
+    """Return the best content coding of the precompressed variants of a file
+    that the client accepts, or None to send the file itself.
+
+    Variants are not used for range requests and when the file is sent by the
+    web server.
+    """
+    if request.range or _get_download_offload():
+        return None
+    encodings = [
+        encoding
+        for encoding in storage.VARIANT_SUFFIXES
+        if storage.is_current_variant(filepath, encoding)
+    ]
+    if not encodings:
+        return None
+    return request.accept_encodings.best_match(encodings)
+
+
+def _get_download_offload() -> Optional[str]:
+    offload = tk.config.get("ckanext.stadtzhtheme.download_offload", "").lower()
+    if offload in ("x-sendfile", "x-accel-redirect"):
+        return offload
+    return None
+
+
+def _is_not_modified(etag: Optional[str], last_modified: Optional[datetime]) -> bool:
+    """Check the conditional headers of the request before the file is opened.
+
+    If-Modified-Since is ignored if the request has an If-None-Match header.
+    """
+    if request.if_none_match:
+        return bool(etag) and request.if_none_match.contains(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def _send_upload(
+    filepath: str,
+    download_name: str,
+    etag: Optional[str] = None,
+    last_modified: Optional[datetime] = None,
+) -> WerkzeugResponse:
+    """Send an uploaded file, or let the web server send it.
+
+    With `ckanext.stadtzhtheme.download_offload = x-sendfile` the path of the
+    file is returned in an `X-Sendfile` header (Apache mod_xsendfile), with
+    `x-accel-redirect` an `X-Accel-Redirect` header with the path below
+    `ckan.storage_path`, prefixed with
+    `ckanext.stadtzhtheme.download_offload_prefix` (nginx, default
+    `/_storage`) is returned.
+
+    The file is sent with the ETag and Last-Modified date of the resource if
+    available (else they are derived from the file), so conditional and range
+    requests are answered by Flask. When the file is sent by the web server,
+    it handles range requests itself.
+    """
+    offload = _get_download_offload()
+    if not offload:
+        return send_file(
+            filepath,
+            download_name=download_name,
+            etag=etag or True,
+            last_modified=last_modified,
+        )
+
+    resp = werkzeug_send_file(
+        filepath,
+        request.environ,
+        download_name=download_name,
+        conditional=False,
+        etag=etag or True,
+        last_modified=last_modified,
+        use_x_sendfile=True,
+    )
+    if etag:
+        # werkzeug only sets the ETag of conditional responses
+        resp.set_etag(etag)
+    if offload == "x-accel-redirect":
+        resp.headers["X-Accel-Redirect"] = _offload_uri(resp.headers.pop("X-Sendfile"))
+    return resp
+
+
+def _offload_uri(filepath: str) -> str:
+    prefix = tk.config.get("ckanext.stadtzhtheme.download_offload_prefix", "/_storage")
+    relpath = os.path.relpath(filepath, tk.config.get("ckan.storage_path"))
+    return quote("%s/%s" % (prefix.rstrip("/"), relpath))
+
+
 ogdzh_dataset.add_url_rule(
     "/<package_name>/download/<resource_name>", view_func=resource_download_permalink
 )
+
+
+def suggest() -> Union[Response, WerkzeugResponse]:
+    """Return the autosuggestions for `q` (and the context `cfq`) as a compact
+    JSON list, with an ETag and Cache-Control header so that proxies and
+    browsers can cache them.
+
+    The ETag is a hash of the response body, so it always matches the
+    suggestions that are served, whichever process or cache they come from.
+    """
+    q = request.args.get("q", "")
+    cfq = request.args.get("cfq", "")
+    if not q.strip():
+        return abort(400, _("Missing value") + ": q")
+
+    try:
+        suggestions = ogdzh_logic.get_suggestions(q, cfq)
+    except logic.ActionError:
+        return abort(503, _("Error retrieving suggestions"))
+    body = json.dumps(suggestions, separators=(",", ":"), ensure_ascii=False)
+    etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+    if etag in request.if_none_match:
+        resp = CachedResponse("", 304)
+    else:
+        resp = CachedResponse(body, content_type="application/json; charset=utf-8")
+    resp.set_etag(etag)
+    resp.set_cache_control(
+        "public, max-age=%s"
+        % tk.config.get("ckanext.stadtzhtheme.ogdzh_suggest_max_age", 300)
+    )
+    return resp
+
+
+ogdzh_api.add_url_rule("/suggest", view_func=suggest)
@@ -0,0 +1,257 @@
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from flask import g, has_request_context
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+VOCABULARY_CACHE = "vocabulary"
+GROUP_RANKING_CACHE = "group_ranking"
+RESOURCE_VIEWS_CACHE = "resource_views"
+AUTOSUGGEST_CACHE = "autosuggest"
+RESOURCE_PERMALINK_CACHE = "resource_permalink"
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+_package_show_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+
+class TTLCache(object):
+    """A small thread-safe in-memory cache.
+
+    Entries expire after `ttl` seconds (no expiry if `ttl` is 0). If `maxsize` is
+    set, the least recently used entry is evicted once the cache is full.
+    """
+
+    def __init__(self, ttl=300, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires, value = entry
+                if not expires or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """Return the value for `key` without counting a hit or a miss and
+        without changing its position in the LRU order.
+        """
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        expires, value = entry
+        if expires and expires <= time.monotonic():
+            return default
+        return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            if self.maxsize:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def get_or_set(self, key, factory):
+        """Return the cached value for `key`, calling `factory()` on a miss."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """Remove `key` from the cache, or everything if no key is given."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / total if total else 0.0,
+        }
+
+
+def get_cache(name, ttl=300, maxsize=None):
+    """Return the process-wide cache called `name`, creating it on first use.
+
+    The defaults can be overridden in the config with
+    `ckanext.stadtzhtheme.<name>_cache_ttl` and
+    `ckanext.stadtzhtheme.<name>_cache_size`.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            prefix = "ckanext.stadtzhtheme.%s_cache" % name
+            _caches[name] = TTLCache(
+                ttl=int(tk.config.get(prefix + "_ttl", ttl)),
+                maxsize=int(tk.config.get(prefix + "_size", maxsize or 0)) or None,
+            )
+        return _caches[name]
+
+
+def invalidate_cache(name, key=None):
+    """Invalidate an entry of the cache `name` (or all of it) if it exists."""
+    cache = _caches.get(name)
+    if cache is not None:
+        cache.invalidate(key)
+
+
+def invalidate_after_commit(*names):
+    """Invalidate the caches `names` once the current database transaction
+    has ended, or right away if there is none.
+
+    The dataset hooks run before the changes are committed and indexed, so a
+    concurrent request could otherwise cache the old data again.
+    """
+    session = model.Session()
+    if not session.in_transaction():
+        for name in names:
+            invalidate_cache(name)
+        return
+    session.info.setdefault("stadtzhtheme_invalidate", set()).update(names)
+
+
+@event.listens_for(model.Session, "after_commit")
+@event.listens_for(model.Session, "after_rollback")
+def _invalidate_pending(session):
+    # also on a rollback, as it may only end a savepoint of the transaction
+    for name in session.info.pop("stadtzhtheme_invalidate", ()):
+        invalidate_cache(name)
+
+
+def clear_caches():
+    """Throw away all process-wide caches, e.g. between tests."""
+    with _caches_lock:
+        _caches.clear()
+
+
+def cache_stats():
+    """Return the statistics of all process-wide caches by name, and of the
+    request-scoped package_show cache as `package_show`.
+    """
+    with _caches_lock:
+        caches = dict(_caches)
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    stats["package_show"] = package_show_stats()
+    return stats
+
+
+def request_cache(name):
+    """Return a dict that lives as long as the current request.
+
+    Outside of a request (e.g. in background jobs) a new empty dict is
+    returned on every call, so nothing is cached.
+    """
+    if not has_request_context():
+        return {}
+    caches = g.setdefault("stadtzhtheme_request_caches", {})
+    return caches.setdefault(name, {})
+
+
+def cached_package_show(context, package_id):
+    """Call package_show, memoizing the result for the rest of the request.
+
+    Results are cached per user and package id (or name). Callers get their
+    own copy of the dict and may modify it. When a package is written, the
+    dataset hooks of the plugin call `invalidate_package`.
+    """
+    cache = request_cache("package_show")
+    key = (context.get("user"), package_id)
+    if key in cache:
+        _count_package_show("hits")
+        log.debug("package_show cache hit for %s", package_id)
+        return copy.deepcopy(cache[key])
+
+    _count_package_show("misses")
+    package = tk.get_action("package_show")(context, {"id": package_id})
+    cache[key] = copy.deepcopy(package)
+    return package
+
+
+def invalidate_package(package_id):
+    """Remove a package (given by id or name) from the request cache."""
+    cache = request_cache("package_show")
+    for key, package in list(cache.items()):
+        if package_id in (key[1], package.get("id"), package.get("name")):
+            del cache[key]
+
+
+def permalink_resources(package_name):
+    """Return the resources of a package by their name, for download permalinks.
+
+    Unlike `cached_package_show`, this is cached across requests: a permalink
+    request needs the package once, but the same permalinks are requested
+    over and over.
+
+    The package is loaded without an authorization check, callers have to
+    check that the user may see the resource, and must not modify the
+    returned dicts. The resources are kept in the resource permalink cache
+    (60 seconds by default), which is invalidated whenever a dataset or
+    resource is written in this process.
+    """
+
+    def load_resources():
+        package = tk.get_action("package_show")(
+            {"ignore_auth": True}, {"id": package_name}
+        )
+        resources = {}
+        for resource in package["resources"]:
+            # the first resource with a name wins, like in the dataset page
+            resources.setdefault(resource["name"], resource)
+        return resources
+
+    cache = get_cache(RESOURCE_PERMALINK_CACHE, ttl=60, maxsize=1000)
+    return cache.get_or_set(package_name, load_resources)
+
+
+def package_show_stats():
+    """Return the hit/miss counters of the request-scoped package_show cache
+    since the process started.
+    """
+    with _stats_lock:
+        hits = _package_show_stats["hits"]
+        misses = _package_show_stats["misses"]
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": float(hits) / total if total else 0.0,
+    }
+
+
+def _count_package_show(counter):
+    with _stats_lock:
+        _package_show_stats[counter] += 1
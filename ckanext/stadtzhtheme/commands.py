@@ -1,12 +1,30 @@
+import heapq
 import itertools
+import json
 import os
 import sys
+import time
 import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import ckan.logic as logic
 import ckan.model as model
 import click
+import sqlalchemy as sa
+from ckan.lib import datapreview
 from ckan.lib.uploader import get_storage_path
+from flask import current_app
+
+from ckanext.datastore.backend.postgres import get_write_engine
+from ckanext.stadtzhtheme.downloads import top_downloads
+from ckanext.stadtzhtheme.storage import (
+    find_duplicates,
+    iter_storage_files,
+    link_duplicate,
+    resource_id_from_path,
+    unlink_duplicate,
+)
 
 
 def get_commands():
@@ -19,49 +37,46 @@ def stadtzhtheme():
 
 
 @stadtzhtheme.command("cleanup_datastore")
-def cleanup_datastore():
-    user = logic.get_action("get_site_user")({"ignore_auth": True}, {})
-    context = {"model": model, "session": model.Session, "user": user["name"]}
+@click.option(
+    "--dry-run", is_flag=True, help="Only list the orphaned tables, don't delete them."
+)
+@click.option(
+    "--workers",
+    default=4,
+    show_default=True,
+    help="Number of tables that are deleted in parallel.",
+)
+def cleanup_datastore(dry_run, workers):
+    context = _get_site_user_context()
     try:
         logic.check_access("datastore_delete", context)
-        logic.check_access("resource_show", context)
+        logic.check_access("datastore_search", context)
     except logic.NotAuthorized:
         click.echo("User is not authorized to perform this action.")
         sys.exit(1)
 
-    # query datastore to get all resources from the _table_metadata
+    # orphaned tables are the datastore tables without an active resource
     resource_id_list = []
     try:
-        for offset in itertools.count(start=0, step=100):
-            click.echo("Load metadata records from datastore (offset: %s)" % offset)
-            record_list, has_next_page = _get_datastore_table_page(context, offset)
-            resource_id_list.extend(record_list)
-            if not has_next_page:
-                break
+        table_names = _get_datastore_table_names(context)
+        resource_id_list = sorted(table_names - _get_active_resource_ids())
     except Exception as e:
         click.echo(
             "Error while gathering resources: %s / %s"
             % (str(e), traceback.format_exc())
         )
+    click.echo("%s orphaned tables found" % len(resource_id_list))
 
-    # delete the rows of the orphaned datastore tables
-    delete_count = 0
-    for resource_id in resource_id_list:
-        try:
-            logic.check_access("datastore_delete", context)
-            logic.get_action("datastore_delete")(
-                context, {"resource_id": resource_id, "force": True}
-            )
-            click.echo("Table '%s' deleted (not dropped)" % resource_id)
-            delete_count += 1
-        except Exception as e:
-            click.echo(
-                "Error while deleting datastore resource %s: %s / %s"
-                % (resource_id, str(e), traceback.format_exc())
-            )
-            continue
+    if dry_run:
+        for resource_id in resource_id_list:
+            click.echo("- %s" % resource_id)
+        return
 
-    click.echo("Deleted content of %s tables" % delete_count)
+    delete_count, reclaimed_bytes = _delete_datastore_tables(resource_id_list, workers)
+    click.echo(
+        "Dropped %s tables, %s reclaimed"
+        % (delete_count, _format_bytes(reclaimed_bytes))
+    )
 
 
 @stadtzhtheme.command("cleanup_filestore")
@@ -70,8 +85,7 @@ def cleanup_filestore():
 
     click.echo("\nClean up file storage at {}:\n".format(resource_path))
 
-    user = logic.get_action("get_site_user")({"ignore_auth": True}, {})
-    context = {"model": model, "session": model.Session, "user": user["name"]}
+    context = _get_site_user_context()
     try:
         logic.check_access("datastore_delete", context)
         logic.check_access("resource_show", context)
@@ -79,68 +93,492 @@ def cleanup_filestore():
         click.echo("User is not authorized to perform this action.")
         sys.exit(1)
 
-    files_to_keep = _cleanup_storage_files(context, resource_path)
-    _delete_orphaned_storage_directories(resource_path)
-    click.echo("{} Files are remaining in storage".format(len(files_to_keep)))
+    # resource_create writes the file before the resource is committed, so
+    # files written after the resource ids were loaded must not be deleted
+    started = time.time()
+    active_resource_ids = _get_active_resource_ids()
+    counts = {"kept": 0, "deleted_files": 0, "deleted_dirs": 0}
+    _cleanup_storage_dir(
+        resource_path, active_resource_ids, counts, is_root=True, started=started
+    )
+    click.echo("{} files were deleted".format(counts["deleted_files"]))
+    click.echo("{} directories were deleted".format(counts["deleted_dirs"]))
+    click.echo("{} Files are remaining in storage".format(counts["kept"]))
+
 
+@stadtzhtheme.command("storage_report")
+@click.option(
+    "--top",
+    default=20,
+    show_default=True,
+    help="Number of entries shown for the largest datasets and files.",
+)
+@click.option(
+    "--no-duplicates",
+    is_flag=True,
+    help="Don't hash the files to find byte-identical uploads.",
+)
+def storage_report(top, no_duplicates):
+    """Report the usage of the file storage."""
+    resource_path = _get_resource_storage_path()
+    click.echo("\nUsage of file storage at {}:\n".format(resource_path))
+
+    resources = _get_resource_metadata()
+    usage = {"organization": Counter(), "dataset": Counter(), "format": Counter()}
+    largest_files = []
+    files = []
+    total_bytes = 0
+    for resource_id, entry in iter_storage_files(resource_path):
+        stat = entry.stat(follow_symlinks=False)
+        organization, dataset, file_format = resources.get(
+            resource_id, ("(orphaned)", "(orphaned)", "(orphaned)")
+        )
+        usage["organization"][organization or "(none)"] += stat.st_size
+        usage["dataset"][dataset] += stat.st_size
+        usage["format"][(file_format or "(none)").lower()] += stat.st_size
+        total_bytes += stat.st_size
 
-def _get_datastore_table_page(context, offset=0):
-    # query datastore to get all resources from the _table_metadata
-    result = logic.get_action("datastore_search")(
-        context, {"resource_id": "_table_metadata", "offset": offset}
+        file_info = (stat.st_size, entry.path, dataset)
+        if len(largest_files) < top:
+            heapq.heappush(largest_files, file_info)
+        else:
+            heapq.heappushpop(largest_files, file_info)
+        if not no_duplicates:
+            files.append((entry.path, stat))
+
+    click.echo("Total: {}".format(_format_bytes(total_bytes)))
+    _echo_usage("organization", usage["organization"].most_common())
+    _echo_usage("dataset", usage["dataset"].most_common(top))
+    _echo_usage("format", usage["format"].most_common())
+
+    click.echo("\nLargest files:")
+    for size, path, dataset in sorted(largest_files, reverse=True):
+        click.echo("- {} {} ({})".format(_format_bytes(size), path, dataset))
+
+    if not no_duplicates:
+        _echo_duplicates(find_duplicates(files))
+
+
+@stadtzhtheme.command("dedupe_filestore")
+@click.option(
+    "--manifest",
+    type=click.Path(dir_okay=False),
+    required=True,
+    help="File that records the replaced files (JSON lines), used by --undo.",
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Only list the duplicates, don't replace them."
+)
+@click.option(
+    "--undo",
+    is_flag=True,
+    help="Replace the hard links recorded in the manifest with copies again.",
+)
+def dedupe_filestore(manifest, dry_run, undo):
+    """Replace byte-identical files in the file storage with hard links."""
+    if undo:
+        _undo_dedupe(manifest, dry_run)
+        return
+
+    resource_path = _get_resource_storage_path()
+    click.echo("\nDeduplicate file storage at {}:\n".format(resource_path))
+    files = [
+        (entry.path, entry.stat(follow_symlinks=False))
+        for resource_id, entry in iter_storage_files(resource_path)
+    ]
+
+    linked_count = 0
+    saved_bytes = 0
+    with open(os.devnull if dry_run else manifest, "a") as manifest_file:
+        for duplicate in find_duplicates(files):
+            original_path = duplicate.paths[0]
+            original_inode = os.stat(original_path).st_ino
+            for path in duplicate.paths[1:]:
+                if os.stat(path).st_ino == original_inode:
+                    continue
+                click.echo("- {} -> {}".format(path, original_path))
+                if dry_run or not link_duplicate(original_path, path):
+                    continue
+                entry = {
+                    "path": path,
+                    "linked_to": original_path,
+                    "sha256": duplicate.digest,
+                    "size": duplicate.size,
+                }
+                manifest_file.write(json.dumps(entry) + "\n")
+                manifest_file.flush()
+                linked_count += 1
+                saved_bytes += duplicate.size
+
+    click.echo(
+        "{} files replaced by hard links, {} saved".format(
+            linked_count, _format_bytes(saved_bytes)
+        )
     )
 
-    resource_id_list = []
-    for record in result["records"]:
-        try:
-            # ignore 'alias' records
-            if record["alias_of"]:
+
+@stadtzhtheme.command("ensure_views")
+@click.option(
+    "--batch-size",
+    default=100,
+    show_default=True,
+    help="Number of datasets that are loaded per batch.",
+)
+@click.option(
+    "--workers",
+    default=4,
+    show_default=True,
+    help="Number of datasets that are processed in parallel.",
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Only list the missing views, don't create them."
+)
+def ensure_views(batch_size, workers, dry_run):
+    """Create the missing default resource views of all datasets."""
+    context = _get_site_user_context()
+    try:
+        logic.check_access("package_create_default_resource_views", context)
+    except logic.NotAuthorized:
+        click.echo("User is not authorized to perform this action.")
+        sys.exit(1)
+
+    dataset_count = _active_datasets_query().count()
+    processed_count = 0
+    missing_count = 0
+    for dataset_ids in _get_dataset_id_batches(batch_size):
+        results = _map_in_app_context(
+            lambda dataset_id: _ensure_dataset_views(dataset_id, dry_run),
+            dataset_ids,
+            workers,
+        )
+        for dataset_id, missing_views, error in results:
+            if error:
+                click.echo(
+                    "Error while ensuring views of dataset %s: %s" % (dataset_id, error)
+                )
                 continue
+            for resource_id, view_type in missing_views:
+                click.echo(
+                    "- %s view '%s' for resource %s (dataset %s)"
+                    % (
+                        "missing" if dry_run else "created",
+                        view_type,
+                        resource_id,
+                        dataset_id,
+                    )
+                )
+            missing_count += len(missing_views)
+        processed_count += len(dataset_ids)
+        click.echo("Processed %s/%s datasets" % (processed_count, dataset_count))
+
+    click.echo(
+        "%s views %s" % (missing_count, "are missing" if dry_run else "were created")
+    )
+
+
+@stadtzhtheme.command("download_stats")
+@click.option(
+    "--top",
+    default=20,
+    show_default=True,
+    help="Number of resources shown.",
+)
+def download_stats(top):
+    """Show the most downloaded resources."""
+    downloads = top_downloads(top)
+    if not downloads:
+        click.echo("No downloads recorded.")
+        return
+    click.echo("\nMost downloaded resources:")
+    for download in downloads:
+        click.echo(
+            "- {}: {}/{} ({})".format(
+                download["count"],
+                download["package_name"] or "(purged)",
+                download["resource_name"] or download["resource_id"],
+                download["resource_id"],
+            )
+        )
+
 
-            logic.check_access("resource_show", context)
-            logic.get_action("resource_show")(context, {"id": record["name"]})
-            click.echo("Resource '%s' found" % record["name"])
-        except logic.NotFound:
-            resource_id_list.append(record["name"])
-            click.echo("Resource '%s' *not* found" % record["name"])
-        except logic.NotAuthorized:
-            click.echo("User is not authorized to perform this action.")
-        except (KeyError, AttributeError) as e:
-            click.echo("Error while handling record %s: %s" % (record, str(e)))
+def _undo_dedupe(manifest, dry_run=False):
+    """Replace the hard links recorded in the manifest with copies."""
+    restored_count = 0
+    with open(manifest, "r") as manifest_file:
+        entries = [json.loads(line) for line in manifest_file if line.strip()]
+    for entry in entries:
+        path = entry["path"]
+        # skip files that have been deleted or replaced by a new upload
+        if not os.path.exists(path) or os.stat(path).st_nlink < 2:
             continue
+        click.echo("- restoring {}".format(path))
+        if not dry_run:
+            unlink_duplicate(path)
+            restored_count += 1
+    click.echo("{} files restored".format(restored_count))
+
+
+def _get_resource_metadata():
+    """Return a dict of all active resources, mapping their id to a tuple of
+    (organization name, dataset name, format), loaded in one query.
+    """
+    query = (
+        model.Session.query(
+            model.Resource.id,
+            model.Group.name,
+            model.Package.name,
+            model.Resource.format,
+        )
+        .join(model.Package, model.Package.id == model.Resource.package_id)
+        .outerjoin(model.Group, model.Group.id == model.Package.owner_org)
+        .filter(model.Resource.state == "active")
+    )
+    return {row[0]: tuple(row[1:]) for row in query}
+
+
+def _echo_usage(label, usage):
+    click.echo("\nBytes per {}:".format(label))
+    for name, size in usage:
+        click.echo("- {}: {}".format(name, _format_bytes(size)))
 
-    # are there more records?
-    has_next_page = len(result["records"]) > 0
-
-    return resource_id_list, has_next_page
-
-
-def _cleanup_storage_files(context, resource_path):
-    files_to_delete = []
-    files_to_keep = []
-    for root, dirs, files in os.walk(resource_path, topdown=True):
-        if files:
-            for file in files:
-                resource_id = "".join(root.split("/")[-2:]) + file
-                file_path = os.path.join(root, file)
-                try:
-                    logic.check_access("resource_show", context)
-                    logic.get_action("resource_show")(context, {"id": resource_id})
-                    files_to_keep.append(file_path)
-                except logic.NotFound:
-                    files_to_delete.append(file_path)
-                except logic.NotAuthorized:
-                    click.echo("User is not authorized to perform this action.")
-                    sys.exit(1)
-                except (KeyError, AttributeError) as e:
-                    raise RuntimeError(
-                        "Error while handling record {}: {}".format(resource_id, str(e))
-                    )
-    click.echo("{} files will be deleted:".format(len(files_to_delete)))
-    for file_path in files_to_delete:
-        os.remove(file_path)
-        click.echo("- deleted: {}".format(file_path))
-    return files_to_keep
+
+def _echo_duplicates(duplicates):
+    duplicates.sort(key=lambda d: d.size * (d.inodes - 1), reverse=True)
+    wasted_bytes = sum(d.size * (d.inodes - 1) for d in duplicates)
+    click.echo(
+        "\n{} groups of identical files, {} could be saved:".format(
+            len(duplicates), _format_bytes(wasted_bytes)
+        )
+    )
+    for duplicate in duplicates:
+        click.echo(
+            "- {} x {} (sha256 {}):".format(
+                len(duplicate.paths), _format_bytes(duplicate.size), duplicate.digest
+            )
+        )
+        for path in duplicate.paths:
+            click.echo("  - {}".format(path))
+
+
+def _get_site_user_context():
+    user = logic.get_action("get_site_user")({"ignore_auth": True}, {})
+    return {"model": model, "session": model.Session, "user": user["name"]}
+
+
+def _map_in_app_context(func, items, workers):
+    """Call `func` for all items in a pool of `workers` threads.
+
+    Every call runs in its own Flask request context and database session.
+    Yields (item, result, error) tuples in the order of the items, as soon as
+    they are available.
+    """
+    app = current_app._get_current_object()
+
+    def run(item):
+        with app.test_request_context():
+            try:
+                return item, func(item), None
+            except Exception as e:
+                return item, None, e
+            finally:
+                model.Session.remove()
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for result in executor.map(run, items):
+            yield result
+
+
+def _active_datasets_query():
+    return model.Session.query(model.Package.id).filter(
+        model.Package.state == "active", model.Package.type == "dataset"
+    )
+
+
+def _get_dataset_id_batches(batch_size):
+    """Yield the ids of all active datasets in batches of `batch_size`."""
+    last_id = ""
+    while True:
+        batch = [
+            row.id
+            for row in _active_datasets_query()
+            .filter(model.Package.id > last_id)
+            .order_by(model.Package.id)
+            .limit(batch_size)
+        ]
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1]
+
+
+def _ensure_dataset_views(dataset_id, dry_run=False):
+    """Create the missing default views of a dataset's resources and return
+    them as a list of (resource_id, view_type) tuples.
+    """
+    context = _get_site_user_context()
+    dataset = logic.get_action("package_show")(context, {"id": dataset_id})
+    missing_views = _get_missing_views(dataset)
+    if missing_views and not dry_run:
+        logic.get_action("package_create_default_resource_views")(
+            context, {"package": dataset}
+        )
+    return missing_views
+
+
+def _get_missing_views(dataset):
+    """Return the views that package_create_default_resource_views would
+    create for a dataset, as a list of (resource_id, view_type) tuples.
+    """
+    resource_ids = [r["id"] for r in dataset["resources"]]
+    if not resource_ids:
+        return []
+
+    existing_views = set(
+        model.Session.query(
+            model.ResourceView.resource_id, model.ResourceView.view_type
+        )
+        .filter(model.ResourceView.resource_id.in_(resource_ids))
+        .all()
+    )
+    missing_views = []
+    for resource in dataset["resources"]:
+        for view_plugin in datapreview.get_default_view_plugins():
+            view_type = view_plugin.info()["name"]
+            if (resource["id"], view_type) in existing_views:
+                continue
+            if view_plugin.can_view({"resource": resource, "package": dataset}):
+                missing_views.append((resource["id"], view_type))
+    return missing_views
+
+
+def _get_datastore_table_names(context, page_size=1000):
+    """Return the names of all datastore tables (without aliases)."""
+    table_names = set()
+    for offset in itertools.count(start=0, step=page_size):
+        click.echo("Load metadata records from datastore (offset: %s)" % offset)
+        result = logic.get_action("datastore_search")(
+            context,
+            {
+                "resource_id": "_table_metadata",
+                "offset": offset,
+                "limit": page_size,
+            },
+        )
+        for record in result["records"]:
+            # ignore 'alias' records
+            if not record.get("alias_of"):
+                table_names.add(record["name"])
+        if len(result["records"]) < page_size:
+            return table_names
+
+
+def _delete_datastore_tables(resource_id_list, workers):
+    """Delete the given datastore tables in parallel.
+
+    Returns the number of deleted tables and their total size in bytes.
+    """
+    delete_count = 0
+    reclaimed_bytes = 0
+    results = _map_in_app_context(_delete_datastore_table, resource_id_list, workers)
+    for resource_id, table_size, error in results:
+        if error:
+            click.echo(
+                "Error while deleting datastore resource %s: %s" % (resource_id, error)
+            )
+            continue
+        click.echo("Table '%s' dropped (%s)" % (resource_id, _format_bytes(table_size)))
+        delete_count += 1
+        reclaimed_bytes += table_size
+    return delete_count, reclaimed_bytes
+
+
+def _delete_datastore_table(resource_id):
+    """Delete a datastore table and return its size in bytes before the
+    deletion.
+
+    datastore_delete without filters drops the whole table.
+    """
+    engine = get_write_engine()
+    with engine.connect() as connection:
+        table_size = connection.execute(
+            sa.text("SELECT pg_total_relation_size(quote_ident(:name))"),
+            {"name": resource_id},
+        ).scalar()
+
+    logic.get_action("datastore_delete")(
+        _get_site_user_context(), {"resource_id": resource_id, "force": True}
+    )
+    return table_size or 0
+
+
+def _format_bytes(num_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num_bytes) < 1024:
+            return "%.1f %s" % (num_bytes, unit)
+        num_bytes /= 1024.0
+    return "%.1f TB" % num_bytes
+
+
+def _get_active_resource_ids():
+    """Return the ids of all active resources, loaded in one query."""
+    query = model.Session.query(model.Resource.id).filter(
+        model.Resource.state == "active"
+    )
+    return {row.id for row in query}
+
+
+def _cleanup_storage_dir(
+    dir_path, active_resource_ids, counts, is_root=False, started=None
+):
+    """Delete the files of inactive resources below `dir_path` and prune the
+    directories that are empty afterwards, in a single bottom-up pass.
+
+    Resource files are stored as <storage>/resources/<id[0:3]>/<id[3:6]>/<id[6:]>.
+    Files and directories modified after `started` (a timestamp taken before
+    the active resource ids were loaded) are kept, as they might belong to a
+    resource that is being created. Returns whether `dir_path` still exists.
+    """
+    # checked before the directory is changed by deleting files
+    is_new = _is_newer(dir_path, started)
+    remaining = 0
+    with os.scandir(dir_path) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if _cleanup_storage_dir(
+                entry.path, active_resource_ids, counts, started=started
+            ):
+                remaining += 1
+            continue
+
+        resource_id = resource_id_from_path(dir_path, entry.name)
+        if resource_id in active_resource_ids or _is_newer(entry.path, started):
+            counts["kept"] += 1
+            remaining += 1
+        else:
+            os.remove(entry.path)
+            counts["deleted_files"] += 1
+            click.echo("- deleted: {}".format(entry.path))
+
+    if remaining or is_root or is_new:
+        return True
+    try:
+        os.rmdir(dir_path)
+    except OSError:
+        # a file was added meanwhile
+        return True
+    counts["deleted_dirs"] += 1
+    click.echo("- deleted {}".format(dir_path))
+    return False
+
+
+def _is_newer(path, started):
+    if started is None:
+        return False
+    try:
+        return os.stat(path).st_mtime >= started
+    except FileNotFoundError:
+        return False
 
 
 def _get_resource_storage_path():
@@ -154,24 +592,3 @@ def _get_resource_storage_path():
         sys.exit(1)
     else:
         return os.path.join(storage_path, "resources")
-
-
-def _delete_orphaned_storage_directories(resource_path):
-    """delete orphaned storage directories"""
-    dirs_to_delete = []
-    for dir in os.listdir(resource_path):
-        dir_path = os.path.join(resource_path, dir)
-        subdirs = os.listdir(dir_path)
-        dir_empty = True
-        for subdir in subdirs:
-            subdir_path = os.path.join(dir_path, subdir)
-            if not os.listdir(subdir_path):
-                dirs_to_delete.append(subdir_path)
-            else:
-                dir_empty = False
-        if dir_empty:
-            dirs_to_delete.append(dir_path)
-    click.echo("{} directories will be deleted:".format(len(dirs_to_delete)))
-    for dir_path in dirs_to_delete:
-        os.rmdir(dir_path)
-        click.echo("- deleted {}".format(dir_path))
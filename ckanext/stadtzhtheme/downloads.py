@@ -0,0 +1,162 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+import ckan.plugins.toolkit as tk
+from ckan import model
+from ckan.lib.uploader import get_storage_path
+
+log = logging.getLogger(__name__)
+
+
+class DownloadCounter(object):
+    """Count downloads per resource in memory and append the counts to a file
+    every `interval` seconds.
+
+    The counts are written by a background thread (see `start`), so counting
+    a download never waits for the file, and counts are written after a quiet
+    period too. Every flush appends one JSON line with the counts since the
+    last flush; the file is locked while writing, so several processes can
+    share it.
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def add(self, resource_id, count=1):
+        with self._lock:
+            self._counts[resource_id] += count
+
+    def start(self):
+        """Start the daemon thread that flushes the counts every `interval`
+        seconds.
+        """
+        threading.Thread(target=self._run, name="download_stats", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered counts now."""
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, Counter()
+            if not counts:
+                return
+            try:
+                write_counts(self.path, counts)
+            except OSError as e:
+                log.warning("Could not write download statistics: %s" % e)
+                # keep the counts for the next flush
+                with self._lock:
+                    self._counts.update(counts)
+
+
+def write_counts(path, counts):
+    line = json.dumps(
+        {"time": datetime.now(timezone.utc).isoformat(), "counts": dict(counts)}
+    )
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line + "\n")
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_counts(path):
+    """Return the total downloads per resource recorded in the file `path`."""
+    totals = Counter()
+    if not os.path.exists(path):
+        return totals
+    with open(path) as f:
+        for line in f:
+            try:
+                totals.update(json.loads(line)["counts"])
+            except (ValueError, KeyError, TypeError):
+                log.warning("Skipping invalid line in %s" % path)
+    return totals
+
+
+_counter = None
+_counter_lock = threading.Lock()
+
+
+def download_stats_path():
+    """Return the file the download counts are written to, configured with
+    `ckanext.stadtzhtheme.download_stats_path` (default
+    `<ckan.storage_path>/download_stats.jsonl`), or None if there is none.
+    """
+    path = tk.config.get("ckanext.stadtzhtheme.download_stats_path")
+    if not path and get_storage_path():
+        path = os.path.join(get_storage_path(), "download_stats.jsonl")
+    return path or None
+
+
+def get_download_counter():
+    """Return the process-wide download counter, flushing every
+    `ckanext.stadtzhtheme.download_stats_flush_interval` seconds (default 60),
+    or None if there is no file to write the counts to.
+    """
+    global _counter
+    with _counter_lock:
+        if _counter is None:
+            path = download_stats_path()
+            if not path:
+                return None
+            _counter = DownloadCounter(
+                path,
+                interval=float(
+                    tk.config.get(
+                        "ckanext.stadtzhtheme.download_stats_flush_interval", 60
+                    )
+                ),
+            )
+            _counter.start()
+            atexit.register(_counter.flush)
+        return _counter
+
+
+def count_download(resource_id):
+    counter = get_download_counter()
+    if counter is not None:
+        counter.add(resource_id)
+
+
+def top_downloads(limit=10):
+    """Return the `limit` most downloaded resources as dicts with the
+    `resource_id`, `resource_name`, `package_name` (None for purged
+    resources) and `count`, including the counts of this process that were
+    not written yet.
+    """
+    counter = get_download_counter()
+    if counter is None:
+        return []
+    counter.flush()
+
+    top = []
+    for resource_id, count in read_counts(counter.path).most_common(limit):
+        resource = model.Resource.get(resource_id)
+        top.append(
+            {
+                "resource_id": resource_id,
+                "resource_name": resource.name if resource else None,
+                "package_name": resource.package.name if resource else None,
+                "count": count,
+            }
+        )
+    return top
@@ -0,0 +1,86 @@
+import logging
+import os
+
+import ckan.lib.uploader as uploader
+import ckan.plugins.toolkit as tk
+
+from ckanext.stadtzhtheme import storage
+
+log = logging.getLogger(__name__)
+
+_s3filestore = False
+
+
+def detect_s3filestore(config):
+    """Remember whether uploads are stored by the s3filestore plugin, checked
+    once when the plugins are loaded instead of on every download.
+    """
+    global _s3filestore
+    _s3filestore = "s3filestore" in tk.aslist(config.get("ckan.plugins", ""))
+
+
+def uses_s3filestore():
+    return _s3filestore
+
+
+def precompress_formats():
+    """Return the formats of uploads that are precompressed, configured as a
+    space-separated list with `ckanext.stadtzhtheme.precompress_formats`.
+    """
+    formats = tk.config.get(
+        "ckanext.stadtzhtheme.precompress_formats", "csv json geojson"
+    )
+    return {f.lower() for f in tk.aslist(formats)}
+
+
+def is_precompressed(resource):
+    """Check if precompressed variants are kept for a resource."""
+    return (
+        resource.get("url_type") == "upload"
+        and (resource.get("format") or "").lower() in precompress_formats()
+        and not uses_s3filestore()
+    )
+
+
+def enqueue_precompress(resource):
+    """Enqueue a background job to precompress the upload of a resource, or
+    remove its variants right away if it is not precompressed (anymore), e.g.
+    after a CSV was replaced by an XLSX or by a link.
+    """
+    if is_precompressed(resource):
+        tk.enqueue_job(
+            precompress_resource,
+            [resource["id"]],
+            title="Precompress resource %s" % resource["id"],
+        )
+    elif not uses_s3filestore() and uploader.get_storage_path():
+        # the uploader takes the upload out of the dict it gets
+        path = uploader.ResourceUpload({}).get_path(resource["id"])
+        storage.remove_variants(path)
+
+
+def precompress_resource(resource_id):
+    """Write the precompressed variants of an uploaded resource that are
+    missing or outdated, or remove them if the resource is not precompressed
+    anymore.
+    """
+    try:
+        resource = tk.get_action("resource_show")(
+            {"ignore_auth": True}, {"id": resource_id}
+        )
+    except tk.ObjectNotFound:
+        log.info("Resource %s not found, not precompressing it" % resource_id)
+        return
+
+    path = uploader.get_resource_uploader(resource).get_path(resource_id)
+    if not is_precompressed(resource) or not os.path.exists(path):
+        storage.remove_variants(path)
+        return
+
+    for encoding in storage.available_encodings():
+        if storage.is_current_variant(path, encoding):
+            continue
+        if storage.write_variant(path, encoding):
+            log.info("Wrote %s variant of resource %s" % (encoding, resource_id))
+        else:
+            log.info("No %s variant for resource %s" % (encoding, resource_id))
@@ -1,14 +1,56 @@
+import heapq
+import json
 import logging
+import re
+import time
+from concurrent.futures import wait
 
 import ckan.plugins.toolkit as tk
 import pysolr
-from ckan.lib.search.common import make_connection
+import requests
 from ckan.logic import ActionError
-from ckan.plugins.toolkit import get_or_bust, side_effect_free
+from ckan.plugins.toolkit import chained_action, get_or_bust, side_effect_free
+
+from ckanext.stadtzhtheme import downloads, metrics, suggest
+from ckanext.stadtzhtheme.cache import (
+    AUTOSUGGEST_CACHE,
+    GROUP_RANKING_CACHE,
+    VOCABULARY_CACHE,
+    cache_stats,
+    get_cache,
+    invalidate_cache,
+)
 
 log = logging.getLogger(__name__)
 
 
+def _invalidate_after(action_name, *cache_names):
+    """Create a chained action that invalidates the given process-wide caches
+    after the original action has run.
+    """
+
+    @chained_action
+    def action(original_action, context, data_dict):
+        result = original_action(context, data_dict)
+        for cache_name in cache_names:
+            invalidate_cache(cache_name)
+        return result
+
+    action.__name__ = action_name
+    return action
+
+
+tag_create = _invalidate_after("tag_create", VOCABULARY_CACHE)
+tag_delete = _invalidate_after("tag_delete", VOCABULARY_CACHE)
+vocabulary_update = _invalidate_after("vocabulary_update", VOCABULARY_CACHE)
+vocabulary_delete = _invalidate_after("vocabulary_delete", VOCABULARY_CACHE)
+group_create = _invalidate_after("group_create", GROUP_RANKING_CACHE)
+group_update = _invalidate_after("group_update", GROUP_RANKING_CACHE)
+group_delete = _invalidate_after("group_delete", GROUP_RANKING_CACHE)
+member_create = _invalidate_after("member_create", GROUP_RANKING_CACHE)
+member_delete = _invalidate_after("member_delete", GROUP_RANKING_CACHE)
+
+
 @side_effect_free
 def ogdzh_autosuggest(context, data_dict):
     """
@@ -22,14 +64,135 @@ def ogdzh_autosuggest(context, data_dict):
              as a list of unique suggestions
     """
     q = get_or_bust(data_dict, "q")
-    cfq = data_dict.get("cfq", "")
+    if not _is_valid_query(data_dict):
+        raise tk.ValidationError({"q": ["q and cfq must be strings"]})
+    return get_suggestions(q, data_dict.get("cfq", ""))
+
+
+@side_effect_free
+def ogdzh_autosuggest_batch(context, data_dict):
+    """
+    collecting autosuggestions for several search terms in one call,
+    the queries are resolved concurrently
+    :param queries: a list of queries, each with a `q` and an optional `cfq`
+           like in ogdzh_autosuggest (JSON encoded in GET requests)
+           example: [{"q": "velo"}, {"q": "bev", "cfq": "soziales"}]
+    :return: a list with the autosuggestions of every query,
+             in the order of the queries
+    """
+    queries = _parse_autosuggest_queries(get_or_bust(data_dict, "queries"))
+
+    if suggest_backend() == "local":
+        # build the index here, the queries are resolved in other threads
+        suggest.ensure_local_index()
+    futures = [
+        suggest.get_executor("autosuggest_batch").submit(
+            get_suggestions, query["q"], query.get("cfq", "")
+        )
+        for query in queries
+    ]
+    return [future.result() for future in futures]
+
+
+@side_effect_free
+def ogdzh_autosuggest_metrics(context, data_dict):
+    """
+    metrics of the autosuggestions collected by this process,
+    only available to sysadmins
+    :return: counters (e.g. solr errors), histograms of the latency and
+             the number of suggestions and the statistics of the caches
+    """
+    tk.check_access("sysadmin", context, data_dict)
+    result = metrics.snapshot()
+    result["caches"] = {AUTOSUGGEST_CACHE: _autosuggest_cache().stats()}
+    return result
+
+
+@side_effect_free
+def ogdzh_cache_stats(context, data_dict):
+    """
+    statistics of the caches of this process, only available to sysadmins
+    :return: the size, hits, misses and hit rate of every process-wide cache
+             and the hits, misses and hit rate of the request-scoped
+             package_show cache
+    """
+    tk.check_access("sysadmin", context, data_dict)
+    return cache_stats()
 
+
+@side_effect_free
+def ogdzh_download_stats(context, data_dict):
+    """
+    the most downloaded resources, counted by the download permalinks,
+    only available to sysadmins
+    :param limit: the number of resources to return (default: 10)
+    :return: a list of dicts with the resource_id, resource_name,
+             package_name and count of downloads, most downloaded first
+    """
+    tk.check_access("sysadmin", context, data_dict)
+    try:
+        limit = int(data_dict.get("limit", 10))
+    except ValueError:
+        raise tk.ValidationError({"limit": ["Must be an integer"]})
+    return downloads.top_downloads(limit)
+
+
+def _parse_autosuggest_queries(queries):
+    if isinstance(queries, str):
+        try:
+            queries = json.loads(queries)
+        except ValueError:
+            raise tk.ValidationError({"queries": ["Invalid JSON"]})
+    if not isinstance(queries, list) or not all(
+        _is_valid_query(query) for query in queries
+    ):
+        raise tk.ValidationError(
+            {
+                "queries": [
+                    "Must be a list of objects with a search term q "
+                    "and an optional context cfq, both strings"
+                ]
+            }
+        )
+
+    batch_limit = int(
+        tk.config.get("ckanext.stadtzhtheme.ogdzh_autosuggest_batch_limit", 10)
+    )
+    if len(queries) > batch_limit:
+        raise tk.ValidationError(
+            {"queries": ["At most %s queries are allowed" % batch_limit]}
+        )
+    return queries
+
+
+def _is_valid_query(query):
+    return (
+        isinstance(query, dict)
+        and isinstance(query.get("q"), str)
+        and bool(query["q"].strip())
+        and isinstance(query.get("cfq", ""), str)
+    )
+
+
+def get_suggestions(q, cfq=""):
+    """Return the autosuggestions for the search term `q` in the context `cfq`.
+
+    Suggestions are kept in the process-wide autosuggest cache, keyed on the
+    normalized search term, the context and the limits. The cache is
+    invalidated whenever a dataset is indexed.
+    """
+    with metrics.timed("autosuggest_latency_seconds"):
+        terms = _get_suggestions(q, cfq)
+    metrics.observe("autosuggest_result_size", len(terms), metrics.RESULT_SIZE_BUCKETS)
+    return terms
+
+
+def _get_suggestions(q, cfq):
+    q = normalize_query(q)
     if cfq:
         cfq = "active AND %s" % cfq
     else:
         cfq = "active"
-    handler = "/suggest"
-    suggester = "default"
     suggest_search_limit = int(
         tk.config.get("ckanext.stadtzhtheme.ogdzh_autosuggest_search_limit", 100)
     )
@@ -37,31 +200,227 @@ def ogdzh_autosuggest(context, data_dict):
         tk.config.get("ckanext.stadtzhtheme.ogdzh_autosuggest_result_limit", 10)
     )
 
+    cache = _autosuggest_cache()
+    key = (q, cfq, suggest_search_limit, suggest_results_limit)
+    entry = cache.get(key)
+    if entry is None:
+        entry = _reuse_prefix_suggestions(cache, key) or _load_top_suggestions(
+            q, cfq, suggest_results_limit, suggest_search_limit
+        )
+        cache.set(key, entry)
+
+    terms = top_terms(entry[0], suggest_results_limit)
+    log.debug("suggestions found: {}".format(terms))
+    return terms
+
+
+def _autosuggest_cache():
+    return get_cache(AUTOSUGGEST_CACHE, ttl=300, maxsize=1000)
+
+
+def top_terms(suggestions, limit):
+    """Return the `limit` unique terms with the highest weight.
+
+    Terms with the same weight are ordered alphabetically, so the result is
+    stable for the same suggestions.
+    """
+    weights = {}
+    for suggestion in suggestions:
+        term = suggestion["term"]
+        weight = suggestion.get("weight") or 0
+        if term not in weights or weight > weights[term]:
+            weights[term] = weight
+    top = heapq.nsmallest(limit, weights.items(), key=lambda tw: (-tw[1], tw[0]))
+    return [term for term, weight in top]
+
+
+def _load_top_suggestions(q, cfq, suggest_results_limit, suggest_search_limit):
+    """Load only as many suggestions as needed for the top terms.
+
+    The backends return the suggestions ordered by weight, so starting with
+    twice the result limit, suggest.count is doubled (up to the search limit)
+    only while there are not enough unique terms.
+    """
+    count = min(suggest_results_limit * 2, suggest_search_limit)
+    while True:
+        suggestions, complete = _load_suggestions(q, cfq, count)
+        unique_terms = len(set(suggestion["term"] for suggestion in suggestions))
+        if (
+            complete
+            or count >= suggest_search_limit
+            or unique_terms >= suggest_results_limit
+        ):
+            return suggestions, complete
+        count = min(count * 2, suggest_search_limit)
+
+
+def normalize_query(q):
+    return " ".join(q.split()).lower()
+
+
+def suggest_backend():
+    """Return the configured autosuggest backend, `solr` (default) or `local`."""
+    return tk.config.get("ckanext.stadtzhtheme.ogdzh_autosuggest_backend", "solr")
+
+
+def _load_suggestions(q, cfq, suggest_count):
+    """Load suggestions from the configured backend.
+
+    Returns a tuple of the list of suggestions (dicts with `term` and `weight`)
+    and a flag whether these are all suggestions the backend knows for `q`.
+    """
+    backend = suggest_backend()
+    with metrics.timed("autosuggest_%s_latency_seconds" % backend):
+        if backend == "local":
+            suggest.ensure_local_index()
+            return suggest.local_index.search(q, cfq, suggest_count)
+        return _load_solr_suggestions(q, cfq, suggest_count)
+
+
+def suggesters():
+    """Return the names of the solr suggesters to query, configured as a
+    space-separated list with `ckanext.stadtzhtheme.ogdzh_autosuggest_suggesters`.
+    """
+    return tk.aslist(
+        tk.config.get("ckanext.stadtzhtheme.ogdzh_autosuggest_suggesters", "default")
+    )
+
+
+def _load_solr_suggestions(q, cfq, suggest_count):
+    names = suggesters()
+    if len(names) == 1:
+        return _load_suggester_suggestions(names[0], q, cfq, suggest_count)
+    return _load_merged_suggestions(names, q, cfq, suggest_count)
+
+
+def _load_merged_suggestions(names, q, cfq, suggest_count):
+    """Query several suggesters concurrently and merge their suggestions.
+
+    Every suggester has `ckanext.stadtzhtheme.ogdzh_autosuggest_suggester_timeout`
+    seconds (default 1) to answer, which is also the timeout of its solr
+    request, so a slow suggester holds a thread for at most that long.
+    Suggesters that do not answer in time or fail are left out, the
+    suggestions are then not complete.
+
+    The suggesters run in their own thread pool, as this is called from the
+    threads of `ogdzh_autosuggest_batch`. If all its threads are busy, a
+    suggester is queried in the calling thread instead of waiting for one.
+    """
+    timeout = float(
+        tk.config.get("ckanext.stadtzhtheme.ogdzh_autosuggest_suggester_timeout", 1)
+    )
+    deadline = time.monotonic() + timeout
+    futures = {}
+    inline = []
+    for name in names:
+        args = (name, q, cfq, suggest_count, timeout)
+        future = suggest.try_submit(
+            "autosuggest_suggesters", _load_suggester_suggestions, *args
+        )
+        if future is None:
+            inline.append(args)
+        else:
+            futures[future] = name
+    # the suggesters in the pool are already running meanwhile
+    results = [
+        _try_suggester(args[0], _load_suggester_suggestions, *args) for args in inline
+    ]
+
+    done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+    for future in not_done:
+        metrics.increment("autosuggest_suggester_timeouts")
+        log.warning("Suggester %s timed out for %s" % (futures[future], q))
+        results.append(None)
+    results.extend(_try_suggester(futures[future], future.result) for future in done)
+    return _merge_suggester_results(results)
+
+
+def _try_suggester(name, load, *args):
+    """Return the result of `load(*args)`, or None if the suggester failed."""
+    try:
+        return load(*args)
+    except Exception as e:
+        log.warning("Suggester %s did not answer: %s" % (name, e))
+        return None
+
+
+def _merge_suggester_results(results):
+    answered = [result for result in results if result is not None]
+    if not answered:
+        raise ActionError("Error retrieving suggestions from solr")
+    suggestions = []
+    complete = len(answered) == len(results)
+    for suggester_suggestions, suggester_complete in answered:
+        suggestions.extend(suggester_suggestions)
+        complete = complete and suggester_complete
+    return suggestions, complete
+
+
+def _load_suggester_suggestions(suggester, q, cfq, suggest_count, timeout=None):
+    handler = "/suggest"
+
     log.debug(
         "Loading suggestions for {} (cfq: {}) with handler {}, "
-        "suggester {}, result-limit {}, search-limit {}".format(
-            q, cfq, handler, suggester, suggest_results_limit, suggest_search_limit
-        )
+        "suggester {}, count {}".format(q, cfq, handler, suggester, suggest_count)
     )
 
     try:
-        solr = make_connection()
-        results = solr.search(
-            "",
-            search_handler=handler,
-            **{
-                "suggest.q": q,
-                "suggest.count": suggest_search_limit,
-                "suggest.cfq": cfq,
-            }
-        )
+        with suggest.get_solr_pool().connection(timeout=timeout) as solr:
+            results = solr.search(
+                "",
+                search_handler=handler,
+                **{
+                    "suggest.q": q,
+                    "suggest.count": suggest_count,
+                    "suggest.cfq": cfq,
+                    "suggest.dictionary": suggester,
+                }
+            )
         suggestions = list(results.raw_response["suggest"][suggester].values())[0]
         log.debug("suggestions found: {}".format(suggestions))
-        terms = list(
-            set([suggestion["term"] for suggestion in suggestions["suggestions"]])
-        )[:suggest_results_limit]
-        log.debug("suggestions found: {}".format(terms))
-        return list(set(terms))
-    except pysolr.SolrError as e:
+        suggestions = suggestions["suggestions"]
+        return suggestions, len(suggestions) < suggest_count
+    except (pysolr.SolrError, requests.RequestException) as e:
+        metrics.increment("autosuggest_solr_errors")
         log.exception("Could not load suggestions from solr: %s" % e)
         raise ActionError("Error retrieving suggestions from solr")
+    except (KeyError, IndexError, TypeError) as e:
+        # e.g. a suggester that is not configured in solr
+        metrics.increment("autosuggest_solr_errors")
+        log.exception("Unexpected response of suggester %s: %s" % (suggester, e))
+        raise ActionError("Error retrieving suggestions from solr")
+
+
+def _reuse_prefix_suggestions(cache, key):
+    """Answer a query from the cached, complete suggestions of a shorter
+    prefix of its search term, by filtering them.
+
+    This is only done if enabled with
+    `ckanext.stadtzhtheme.ogdzh_autosuggest_prefix_reuse`, as the filter
+    (a case-insensitive prefix match on the words of a suggestion) has to
+    match the analysis of the solr suggester. Search terms with several
+    words are never answered from a shorter prefix.
+    """
+    if not tk.asbool(
+        tk.config.get("ckanext.stadtzhtheme.ogdzh_autosuggest_prefix_reuse", False)
+    ):
+        return None
+
+    q = key[0]
+    if " " in q:
+        return None
+    for length in range(len(q) - 1, 0, -1):
+        entry = cache.peek((q[:length],) + key[1:])
+        if entry is None or not entry[1]:
+            continue
+        suggestions = [
+            suggestion
+            for suggestion in entry[0]
+            if any(
+                word.startswith(q)
+                for word in re.split(r"\W+", suggestion["term"].lower())
+            )
+        ]
+        metrics.increment("autosuggest_prefix_reuses")
+        return suggestions, True
+    return None
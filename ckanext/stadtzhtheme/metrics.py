@@ -0,0 +1,80 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+RESULT_SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+
+
+class Histogram(object):
+    """Count observed values in buckets with upper bounds `buckets`.
+
+    Values larger than the last bound are counted in an additional `+Inf`
+    bucket. The counts are not cumulative.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {
+            "buckets": dict(zip(bounds, self.counts)),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+def increment(name, value=1):
+    """Add `value` to the counter `name`."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS):
+    """Add a value to the histogram `name`, created with `buckets` on first use."""
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(buckets)
+        _histograms[name].observe(value)
+
+
+@contextmanager
+def timed(name):
+    """Observe the duration of the block in seconds in the histogram `name`."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start)
+
+
+def snapshot():
+    """Return all counters and histograms of this process."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "histograms": {
+                name: histogram.snapshot() for name, histogram in _histograms.items()
+            },
+        }
+
+
+def reset():
+    """Throw away all metrics, e.g. between tests."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
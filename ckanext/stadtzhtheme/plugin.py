@@ -17,8 +17,26 @@ from validate_email import validate_email
 
 import ckanext.xloader.interfaces as xi
 from ckanext.stadtzhtheme import logic as ogdzh_logic
-from ckanext.stadtzhtheme.blueprints import ogdzh_dataset
+from ckanext.stadtzhtheme.blueprints import ogdzh_api, ogdzh_dataset
+from ckanext.stadtzhtheme.cache import (
+    AUTOSUGGEST_CACHE,
+    GROUP_RANKING_CACHE,
+    RESOURCE_PERMALINK_CACHE,
+    RESOURCE_VIEWS_CACHE,
+    VOCABULARY_CACHE,
+    cached_package_show,
+    get_cache,
+    invalidate_after_commit,
+    invalidate_cache,
+    invalidate_package,
+)
 from ckanext.stadtzhtheme.commands import get_commands
+from ckanext.stadtzhtheme.jobs import detect_s3filestore, enqueue_precompress
+from ckanext.stadtzhtheme.suggest import (
+    clean_suggestion,
+    index_dataset,
+    remove_dataset,
+)
 
 log = logging.getLogger(__name__)
 
@@ -70,14 +88,7 @@ def create_updateInterval():
 
 def updateInterval():
     """Return the list of intervals from the updateInterval vocabulary."""
-    create_updateInterval()
-    try:
-        updateInterval = tk.get_action("tag_list")(
-            data_dict={"vocabulary_id": "updateInterval"}
-        )
-        return updateInterval
-    except tk.ObjectNotFound:
-        return None
+    return _vocabulary_tags("updateInterval", create_updateInterval)
 
 
 def create_dataType():
@@ -104,12 +115,35 @@ def create_dataType():
 
 def dataType():
     """Return the list of intervals from the dataType vocabulary."""
-    create_dataType()
+    return _vocabulary_tags("dataType", create_dataType)
+
+
+_bootstrapped_vocabularies = set()
+
+
+def _vocabulary_tags(vocabulary_id, create_vocabulary):
+    """Return the tags of a vocabulary from the process-wide vocabulary cache.
+
+    The vocabulary is created (if necessary) only once per process, and the tag
+    list is only reloaded when the cache entry expires or a tag or vocabulary
+    is changed (see the chained actions in logic.py).
+    """
+    cache = get_cache(VOCABULARY_CACHE, ttl=3600)
+    tags = cache.get(vocabulary_id)
+    if tags is not None:
+        return tags
+
+    if vocabulary_id not in _bootstrapped_vocabularies:
+        create_vocabulary()
+        _bootstrapped_vocabularies.add(vocabulary_id)
     try:
-        dataType = tk.get_action("tag_list")(data_dict={"vocabulary_id": "dataType"})
-        return dataType
+        tags = tk.get_action("tag_list")(data_dict={"vocabulary_id": vocabulary_id})
     except tk.ObjectNotFound:
+        # the vocabulary has been deleted, create it again on the next call
+        _bootstrapped_vocabularies.discard(vocabulary_id)
         return None
+    cache.set(vocabulary_id, tags)
+    return tags
 
 
 def groups():
@@ -128,19 +162,29 @@ def biggest_groups(n):
     """
     Returns the n biggest groups, to display on start page.
     """
-    user = tk.get_action("get_site_user")({"ignore_auth": True}, {})
-    context = {"user": user["name"]}
-    data_dict = {
-        "all_fields": True,
-    }
-    groups = tk.get_action("group_list")(context, data_dict)
-    if len(groups) > n:
-        return sorted(groups, key=lambda group: group.get("package_count"))[
-            -1 : -(n + 1) : -1
-        ]
-    else:
+    return group_ranking()[:n]
+
+
+def group_ranking():
+    """
+    Returns all groups ordered by their package count (biggest first).
+
+    The ranking is kept in the process-wide group ranking cache, which is
+    invalidated whenever a dataset, group or group membership is changed, so
+    the groups are only listed again after a change.
+    """
+
+    def rank_groups():
+        user = tk.get_action("get_site_user")({"ignore_auth": True}, {})
+        context = {"user": user["name"]}
+        data_dict = {
+            "all_fields": True,
+        }
+        groups = tk.get_action("group_list")(context, data_dict)
         return sorted(groups, key=lambda group: group.get("package_count"))[::-1]
 
+    return get_cache(GROUP_RANKING_CACHE, ttl=600).get_or_set("groups", rank_groups)
+
 
 def package_has_group(group_name, groups):
     for group in groups:
@@ -163,7 +207,7 @@ def get_package_dict(datasetID):
     user = tk.get_action("get_site_user")({}, {})
     context = {"user": user["name"]}
     try:
-        return tk.get_action("package_show")(context, {"id": datasetID})
+        return cached_package_show(context, datasetID)
     except Exception:
         return {}
 
@@ -210,6 +254,19 @@ def validate_url(key, data, errors, context):
     return url_validator(key, data, errors, context)
 
 
+def _resource_views_cache():
+    return get_cache(RESOURCE_VIEWS_CACHE, ttl=86400, maxsize=10000)
+
+
+def _resource_views_marker(resource):
+    """The state of a resource its default views depend on."""
+    return (
+        resource.get("url"),
+        (resource.get("format") or "").lower(),
+        bool(resource.get("datastore_active")),
+    )
+
+
 class IFacetPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IFacets, inherit=True)
 
@@ -251,6 +308,7 @@ class StadtzhThemePlugin(
         tk.add_resource("assets", "stadtzh_theme")
 
         config["ckan.site_logo"] = "/logo.png"
+        detect_s3filestore(config)
 
     def get_resource_descriptions(self, res):
         res_descr = res.get("description")
@@ -289,6 +347,19 @@ class StadtzhThemePlugin(
     def get_actions(self):
         return {
             "ogdzh_autosuggest": ogdzh_logic.ogdzh_autosuggest,
+            "ogdzh_autosuggest_batch": ogdzh_logic.ogdzh_autosuggest_batch,
+            "ogdzh_autosuggest_metrics": ogdzh_logic.ogdzh_autosuggest_metrics,
+            "ogdzh_cache_stats": ogdzh_logic.ogdzh_cache_stats,
+            "ogdzh_download_stats": ogdzh_logic.ogdzh_download_stats,
+            "tag_create": ogdzh_logic.tag_create,
+            "tag_delete": ogdzh_logic.tag_delete,
+            "vocabulary_update": ogdzh_logic.vocabulary_update,
+            "vocabulary_delete": ogdzh_logic.vocabulary_delete,
+            "group_create": ogdzh_logic.group_create,
+            "group_update": ogdzh_logic.group_update,
+            "group_delete": ogdzh_logic.group_delete,
+            "member_create": ogdzh_logic.member_create,
+            "member_delete": ogdzh_logic.member_delete,
         }
 
     # IValidators
@@ -667,28 +738,40 @@ class StadtzhThemePlugin(
         # clean terms for suggest context
         search_data = self._prepare_suggest_context(search_data, validated_dict)
 
+        # the suggestions may change with the new index
+        if ogdzh_logic.suggest_backend() == "local":
+            index_dataset(search_data)
+        invalidate_cache(AUTOSUGGEST_CACHE)
+
         return search_data
 
     def before_dataset_view(self, pkg_dict):
         if not self.is_supported_package_type(pkg_dict):
             return pkg_dict
 
-        # create resource views if necessary
-        user = tk.get_action("get_site_user")({"ignore_auth": True}, {})
-        context = {"model": model, "session": model.Session, "user": user["name"]}
-        tk.check_access("package_create_default_resource_views", context)
-
-        # get the dataset via API, as the pkg_dict does not contain all fields
-        dataset = tk.get_action("package_show")(context, {"id": pkg_dict["id"]})
-
-        # Make sure resource views are created before showing a dataset
-        tk.get_action("package_create_default_resource_views")(
-            context, {"package": dataset}
-        )
+        # Resource views are created when resources are written (see
+        # _ensure_resource_views), so viewing a dataset does no write work.
         self._replace_resource_download_urls(pkg_dict["resources"], pkg_dict["name"])
 
         return pkg_dict
 
+    # The process-wide caches are only invalidated after the commit, which
+    # also updates the search index. The request cache is up to date already.
+
+    def after_dataset_create(self, context, pkg_dict):
+        invalidate_after_commit(GROUP_RANKING_CACHE)
+
+    def after_dataset_update(self, context, pkg_dict):
+        invalidate_package(pkg_dict["id"])
+        invalidate_after_commit(GROUP_RANKING_CACHE, RESOURCE_PERMALINK_CACHE)
+
+    def after_dataset_delete(self, context, pkg_dict):
+        invalidate_package(pkg_dict["id"])
+        remove_dataset(pkg_dict["id"])
+        invalidate_after_commit(
+            AUTOSUGGEST_CACHE, GROUP_RANKING_CACHE, RESOURCE_PERMALINK_CACHE
+        )
+
     def after_dataset_search(self, search_results, search_params):
         for package in search_results["results"]:
             self._replace_resource_download_urls(package["resources"], package["name"])
@@ -708,11 +791,6 @@ class StadtzhThemePlugin(
                 )
 
     def _prepare_suggest_context(self, search_data, pkg_dict):
-        def clean_suggestion(term):
-            if term:
-                term = term.replace("-", "")
-            return term
-
         search_data["cleaned_groups"] = [
             clean_suggestion(t) for t in search_data["groups"]
         ]
@@ -725,22 +803,81 @@ class StadtzhThemePlugin(
 
     # IBlueprint
     def get_blueprint(self):
-        return ogdzh_dataset
+        return [ogdzh_dataset, ogdzh_api]
 
     # IXloader
 
     def after_upload(self, context, resource_dict, dataset_dict):
         # create resource views after a successful upload to the DataStore
+        self._ensure_resource_views(resource_dict, dataset_dict, context)
+
+    def _ensure_resource_views(self, resource, dataset=None, context=None):
+        """Create the default views of a resource if necessary.
+
+        A marker with the url, format and DataStore state of the resource is
+        kept in the resource views cache, so the views are only ensured again
+        when one of these changes.
+        """
+        marker = _resource_views_marker(resource)
+        views_cache = _resource_views_cache()
+        if views_cache.get(resource["id"]) == marker:
+            return
+
+        if context is None:
+            user = tk.get_action("get_site_user")({"ignore_auth": True}, {})
+            context = {
+                "model": model,
+                "session": model.Session,
+                "user": user["name"],
+                "ignore_auth": True,
+            }
+        if dataset is None:
+            dataset = cached_package_show(context, resource["package_id"])
+
         tk.get_action("resource_create_default_resource_views")(
             context,
             {
-                "resource": resource_dict,
-                "package": dataset_dict,
+                "resource": resource,
+                "package": dataset,
             },
         )
+        views_cache.set(resource["id"], marker)
 
     # IResourceController
 
+    def after_resource_create(self, context, resource):
+        invalidate_cache(RESOURCE_PERMALINK_CACHE)
+        # resource_create has already created the default views
+        _resource_views_cache().set(resource["id"], _resource_views_marker(resource))
+        self._enqueue_precompress_safely(resource)
+
+    def after_resource_update(self, context, resource):
+        invalidate_cache(RESOURCE_PERMALINK_CACHE)
+        self._ensure_resource_views_safely(resource)
+        self._enqueue_precompress_safely(resource)
+
+    def after_resource_delete(self, context, resources):
+        invalidate_cache(RESOURCE_PERMALINK_CACHE)
+
+    def _ensure_resource_views_safely(self, resource):
+        # a failure to create views must not make the resource write fail
+        try:
+            self._ensure_resource_views(resource)
+        except Exception as e:
+            log.exception(
+                "Could not create views for resource %s: %s" % (resource.get("id"), e)
+            )
+
+    def _enqueue_precompress_safely(self, resource):
+        # the downloads work without precompressed variants
+        try:
+            enqueue_precompress(resource)
+        except Exception as e:
+            log.exception(
+                "Could not enqueue precompressing resource %s: %s"
+                % (resource.get("id"), e)
+            )
+
     def _set_resource_filename(self, resource):
         if resource.get("url_type") == "upload" and resource.get("upload"):
             upload = resource["upload"]
@@ -795,7 +932,7 @@ class StadtzhThemePlugin(
             )
 
     def before_resource_create(self, context, resource):
-        dataset = tk.get_action("package_show")(context, {"id": resource["package_id"]})
+        dataset = cached_package_show(context, resource["package_id"])
         dataset_slug = dataset.get("name")
         self._set_resource_filename(resource)
         self._set_markdown_snippet_text(resource, dataset_slug)
@@ -806,7 +943,7 @@ class StadtzhThemePlugin(
             raise tk.ValidationError({"resources": msg})
 
     def before_resource_update(self, context, current, resource):
-        dataset = tk.get_action("package_show")(context, {"id": resource["package_id"]})
+        dataset = cached_package_show(context, resource["package_id"])
         dataset_slug = dataset.get("name")
         self._set_resource_filename(resource)
         self._set_markdown_snippet_text(resource, dataset_slug)
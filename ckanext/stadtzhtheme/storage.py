@@ -0,0 +1,184 @@
+import filecmp
+import gzip
+import hashlib
+import os
+import shutil
+from collections import defaultdict, namedtuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_SIZE = 1024 * 1024
+
+# suffixes of the precompressed variants of a file, by content coding
+VARIANT_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# variants that do not save at least 10% are not kept
+MAX_COMPRESSION_RATIO = 0.9
+
+DuplicateGroup = namedtuple("DuplicateGroup", ["digest", "size", "paths", "inodes"])
+
+
+def resource_id_from_path(dir_path, filename):
+    """Return the id of the resource stored in `dir_path`/`filename`.
+
+    Resource files are stored as <storage>/resources/<id[0:3]>/<id[3:6]>/<id[6:]>,
+    their precompressed variants with an additional suffix.
+    """
+    for suffix in VARIANT_SUFFIXES.values():
+        if filename.endswith(suffix):
+            filename = filename[: -len(suffix)]
+            break
+    return "".join(dir_path.split("/")[-2:]) + filename
+
+
+def iter_storage_files(resource_path):
+    """Yield a (resource_id, os.DirEntry) tuple for every file below
+    `resource_path`, streaming the directory tree with os.scandir.
+    """
+    dirs = [resource_path]
+    while dirs:
+        dir_path = dirs.pop()
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield resource_id_from_path(dir_path, entry.name), entry
+
+
+def file_hash(file_path, chunk_size=CHUNK_SIZE):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_duplicates(files):
+    """Group byte-identical files.
+
+    `files` is an iterable of (path, os.stat_result) tuples. Only files that
+    share their size with another file are hashed, and files that are already
+    hard links of each other are hashed only once.
+    Returns a list of DuplicateGroup tuples, one for every set of files with
+    the same content that are stored in at least two separate inodes.
+    """
+    by_size = defaultdict(list)
+    for path, stat in files:
+        if stat.st_size:
+            by_size[stat.st_size].append((path, stat))
+
+    duplicates = []
+    for size, candidates in by_size.items():
+        if len(candidates) < 2:
+            continue
+        by_digest = defaultdict(list)
+        inode_digests = {}
+        for path, stat in candidates:
+            inode = (stat.st_dev, stat.st_ino)
+            if inode not in inode_digests:
+                inode_digests[inode] = file_hash(path)
+            by_digest[inode_digests[inode]].append(path)
+
+        digest_inodes = defaultdict(int)
+        for digest in inode_digests.values():
+            digest_inodes[digest] += 1
+        for digest, paths in by_digest.items():
+            if digest_inodes[digest] > 1:
+                duplicates.append(
+                    DuplicateGroup(digest, size, sorted(paths), digest_inodes[digest])
+                )
+    return duplicates
+
+
+def link_duplicate(original_path, duplicate_path):
+    """Replace `duplicate_path` with a hard link to `original_path`.
+
+    The files are compared byte by byte first, and the link is swapped in
+    atomically. Returns False if the files are not identical (anymore).
+    This is safe because CKAN never writes into an existing upload: a new
+    upload is written to a temporary file that is then renamed, which breaks
+    the link.
+    """
+    if not filecmp.cmp(original_path, duplicate_path, shallow=False):
+        return False
+    tmp_path = duplicate_path + ".dedupe~"
+    os.link(original_path, tmp_path)
+    os.replace(tmp_path, duplicate_path)
+    return True
+
+
+def unlink_duplicate(path):
+    """Replace a hard link with an independent copy of the file."""
+    tmp_path = path + ".dedupe~"
+    shutil.copy2(path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def available_encodings():
+    """Return the content codings variants can be written for."""
+    return [e for e in VARIANT_SUFFIXES if e != "br" or brotli is not None]
+
+
+def variant_path(path, encoding):
+    return path + VARIANT_SUFFIXES[encoding]
+
+
+def is_current_variant(path, encoding):
+    """Check if the variant of a file exists and was written for its current
+    content: a variant gets the modification time of the file it was written
+    from.
+    """
+    try:
+        return (
+            os.stat(variant_path(path, encoding)).st_mtime_ns
+            == os.stat(path).st_mtime_ns
+        )
+    except FileNotFoundError:
+        return False
+
+
+def write_variant(path, encoding, chunk_size=CHUNK_SIZE):
+    """Write the variant of a file compressed with `encoding` (`gzip` or `br`).
+
+    Returns False (and removes an older variant) if the compressed file would
+    not be at least 10% smaller, or if the file was changed while it was
+    compressed.
+    """
+    target = variant_path(path, encoding)
+    tmp_path = target + ".tmp~"
+    stat = os.stat(path)
+    with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+        if encoding == "gzip":
+            with gzip.GzipFile(filename="", mode="wb", fileobj=dst, mtime=0) as gz:
+                shutil.copyfileobj(src, gz, chunk_size)
+        else:
+            compressor = brotli.Compressor(quality=9)
+            for chunk in iter(lambda: src.read(chunk_size), b""):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+
+    current = os.stat(path)
+    if (
+        current.st_mtime_ns != stat.st_mtime_ns
+        or current.st_size != stat.st_size
+        or os.path.getsize(tmp_path) > stat.st_size * MAX_COMPRESSION_RATIO
+    ):
+        os.remove(tmp_path)
+        remove_variants(path, [encoding])
+        return False
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp_path, target)
+    return True
+
+
+def remove_variants(path, encodings=None):
+    """Remove the precompressed variants of a file."""
+    for encoding in encodings or VARIANT_SUFFIXES:
+        try:
+            os.remove(variant_path(path, encoding))
+        except FileNotFoundError:
+            pass
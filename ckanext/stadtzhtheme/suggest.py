@@ -0,0 +1,394 @@
+import bisect
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as tk
+import pysolr
+import requests
+from ckan.lib.search.common import make_connection
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+SUGGEST_CONTEXT_FIELDS = ("groups", "tags", "license_id", "res_format")
+
+
+def clean_suggestion(term):
+    if term:
+        term = term.replace("-", "")
+    return term
+
+
+def parse_context_query(cfq):
+    """Return the set of contexts required by a context query like
+    'active AND soziales AND csv'.
+    """
+    return {c.strip().lower() for c in cfq.split(" AND ") if c.strip()}
+
+
+class PrefixIndex(object):
+    """In-process index to look up suggestion terms by a prefix of their words.
+
+    Every dataset contributes its title and the cleaned terms of the suggest
+    context (groups, tags, license and formats) as suggestion terms, and the
+    same cleaned terms as contexts to filter by. The words of all terms are
+    kept in a sorted list, so a prefix lookup is a binary search.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._datasets = {}
+        self._term_datasets = defaultdict(set)
+        self._words = []
+        self._word_terms = defaultdict(set)
+        self._dirty = False
+        self.generation = 0
+        self.built = None
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def update(self, dataset_id, terms, contexts):
+        """Add a dataset to the index, replacing an older version of it."""
+        with self._lock:
+            self._remove(dataset_id)
+            terms = frozenset(t for t in terms if t and t.strip())
+            contexts = frozenset(c.lower() for c in contexts if c)
+            self._datasets[dataset_id] = (terms, contexts)
+            for term in terms:
+                self._term_datasets[term].add(dataset_id)
+                for word in term.lower().split():
+                    self._word_terms[word].add(term)
+            self._dirty = True
+            self.generation += 1
+
+    def remove(self, dataset_id):
+        with self._lock:
+            if self._remove(dataset_id):
+                self._dirty = True
+                self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._datasets.clear()
+            self._term_datasets.clear()
+            self._word_terms.clear()
+            self._words = []
+            self._dirty = False
+            self.generation += 1
+            self.built = None
+
+    def _remove(self, dataset_id):
+        if dataset_id not in self._datasets:
+            return False
+        terms, contexts = self._datasets.pop(dataset_id)
+        for term in terms:
+            self._term_datasets[term].discard(dataset_id)
+            if not self._term_datasets[term]:
+                del self._term_datasets[term]
+                for word in term.lower().split():
+                    self._word_terms[word].discard(term)
+                    if not self._word_terms[word]:
+                        del self._word_terms[word]
+        return True
+
+    def search(self, q, cfq="", limit=100):
+        """Return the terms with a word starting with `q` that belong to a
+        dataset matching all contexts of `cfq`.
+
+        Returns a tuple of a list of suggestions (dicts with `term` and
+        `weight`, the number of matching datasets) and a flag whether these are
+        all matching suggestions.
+        """
+        q = q.lower()
+        words = q.split()
+        if not words:
+            return [], True
+        contexts = parse_context_query(cfq)
+
+        with self._lock:
+            if self._dirty:
+                self._words = sorted(self._word_terms)
+                self._dirty = False
+            candidates = set()
+            position = bisect.bisect_left(self._words, words[0])
+            while position < len(self._words) and self._words[position].startswith(
+                words[0]
+            ):
+                candidates.update(self._word_terms[self._words[position]])
+                position += 1
+
+            suggestions = []
+            for term in candidates:
+                if len(words) > 1 and (" " + q) not in (" " + term.lower()):
+                    continue
+                weight = sum(
+                    1
+                    for dataset_id in self._term_datasets[term]
+                    if contexts <= self._datasets[dataset_id][1]
+                )
+                if weight:
+                    suggestions.append({"term": term, "weight": weight})
+
+        suggestions.sort(key=lambda s: (-s["weight"], s["term"]))
+        return suggestions[:limit], len(suggestions) <= limit
+
+
+local_index = PrefixIndex()
+# serializes the rebuilds of the local index
+_rebuild_lock = threading.Lock()
+# guards the swap of the local index and the changes made while it is rebuilt
+_changes_lock = threading.Lock()
+_changes = None
+
+
+def _dataset_entry(search_data):
+    """Return the terms and contexts of a dataset, from the data that is sent
+    to solr.
+    """
+    values = []
+    for field in SUGGEST_CONTEXT_FIELDS:
+        field_values = search_data.get(field) or []
+        if not isinstance(field_values, list):
+            field_values = [field_values]
+        values.extend(clean_suggestion(v) for v in field_values)
+
+    contexts = list(values)
+    private = search_data.get("private") or search_data.get("capacity") == "private"
+    if search_data.get("state") == "active" and not private:
+        contexts.append("active")
+    return [search_data.get("title")] + values, contexts
+
+
+def index_dataset(search_data):
+    """Add a dataset to the local index, from the data that is sent to solr."""
+    _apply_change(search_data["id"], _dataset_entry(search_data))
+
+
+def remove_dataset(dataset_id):
+    """Remove a dataset from the local index."""
+    _apply_change(dataset_id, None)
+
+
+def _apply_change(dataset_id, entry):
+    # changes made while the index is rebuilt are replayed on the new index
+    with _changes_lock:
+        index = local_index
+        if _changes is not None:
+            _changes[dataset_id] = entry
+    if entry is None:
+        index.remove(dataset_id)
+    else:
+        index.update(dataset_id, *entry)
+
+
+def ensure_local_index():
+    """Build the local index from the search index, if it is empty or older
+    than `ckanext.stadtzhtheme.ogdzh_autosuggest_local_index_ttl` seconds.
+
+    Datasets indexed by this process are added to the index right away (see
+    `before_dataset_index`), the periodic rebuild picks up the changes made by
+    other processes. A new index is built in the background of the current
+    one, which is still used by other threads until the new one replaces it.
+    Only the first build makes other threads wait.
+    """
+    ttl = int(
+        tk.config.get("ckanext.stadtzhtheme.ogdzh_autosuggest_local_index_ttl", 3600)
+    )
+    if _is_fresh(local_index, ttl):
+        return
+    if local_index.built is None:
+        _rebuild_lock.acquire()
+    elif not _rebuild_lock.acquire(blocking=False):
+        # another thread is rebuilding it, the current index is good enough
+        return
+    try:
+        if not _is_fresh(local_index, ttl):
+            _rebuild_local_index()
+    finally:
+        _rebuild_lock.release()
+
+
+def _is_fresh(index, ttl):
+    built = index.built
+    return built is not None and time.monotonic() - built < ttl
+
+
+def _rebuild_local_index():
+    global local_index, _changes
+    log.info("Building local suggest index")
+    with _changes_lock:
+        _changes = {}
+    try:
+        index = PrefixIndex()
+        rows = 1000
+        start = 0
+        while True:
+            result = tk.get_action("package_search")(
+                {"ignore_auth": True},
+                {
+                    "q": "*:*",
+                    "fq": "+dataset_type:dataset",
+                    "fl": ["id", "title", "state"] + list(SUGGEST_CONTEXT_FIELDS),
+                    "rows": rows,
+                    "start": start,
+                },
+            )
+            for search_data in result["results"]:
+                index.update(search_data["id"], *_dataset_entry(search_data))
+            start += rows
+            if start >= result["count"]:
+                break
+        index.built = time.monotonic()
+    except Exception:
+        with _changes_lock:
+            _changes = None
+        raise
+
+    with _changes_lock:
+        for dataset_id, entry in _changes.items():
+            if entry is None:
+                index.remove(dataset_id)
+            else:
+                index.update(dataset_id, *entry)
+        local_index = index
+        _changes = None
+    log.info("Local suggest index built with %s datasets" % len(index))
+
+
+class SolrPool(object):
+    """A pool of solr clients that keep their HTTP connections alive.
+
+    At most `size` idle clients are kept. If all clients are in use, a new
+    one is created. A client that has been idle for longer than
+    `health_check_interval` seconds is pinged before it is used again, and a
+    client whose request failed is thrown away.
+    """
+
+    def __init__(self, size=4, timeout=5, health_check_interval=60):
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Yield a client, with a request timeout of `timeout` seconds if given
+        (else the timeout of the pool).
+        """
+        client = self._acquire()
+        client.timeout = self.timeout if timeout is None else timeout
+        try:
+            yield client
+        except (pysolr.SolrError, requests.RequestException):
+            client.get_session().close()
+            raise
+        except Exception:
+            self._release(client)
+            raise
+        self._release(client)
+
+    def _acquire(self):
+        while True:
+            try:
+                client, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._create_client()
+            if time.monotonic() - last_used < self.health_check_interval:
+                return client
+            if self._is_healthy(client):
+                return client
+            client.get_session().close()
+
+    def _release(self, client):
+        if self._idle.qsize() < self.size:
+            self._idle.put((client, time.monotonic()))
+        else:
+            client.get_session().close()
+
+    def _create_client(self):
+        client = make_connection()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        client.session = session
+        client.timeout = self.timeout
+        return client
+
+    def _is_healthy(self, client):
+        try:
+            client.ping()
+            return True
+        except (pysolr.SolrError, requests.RequestException) as e:
+            log.warning("Discarding unhealthy solr connection: %s" % e)
+            return False
+
+
+_solr_pool = None
+_solr_pool_lock = threading.Lock()
+
+
+def get_solr_pool():
+    """Return the process-wide solr pool, configured with
+    `ckanext.stadtzhtheme.ogdzh_autosuggest_solr_pool_size`,
+    `ckanext.stadtzhtheme.ogdzh_autosuggest_solr_timeout` and
+    `ckanext.stadtzhtheme.ogdzh_autosuggest_solr_health_check_interval`.
+    """
+    global _solr_pool
+    with _solr_pool_lock:
+        if _solr_pool is None:
+            prefix = "ckanext.stadtzhtheme.ogdzh_autosuggest_solr"
+            _solr_pool = SolrPool(
+                size=int(tk.config.get(prefix + "_pool_size", 4)),
+                timeout=float(tk.config.get(prefix + "_timeout", 5)),
+                health_check_interval=float(
+                    tk.config.get(prefix + "_health_check_interval", 60)
+                ),
+            )
+        return _solr_pool
+
+
+_executors = {}
+_executor_slots = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name):
+    """Return the process-wide thread pool `name`, creating it on first use.
+
+    The number of threads can be configured with
+    `ckanext.stadtzhtheme.<name>_workers` (default 4).
+    """
+    with _executors_lock:
+        if name not in _executors:
+            workers = int(tk.config.get("ckanext.stadtzhtheme.%s_workers" % name, 4))
+            _executors[name] = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=name
+            )
+            _executor_slots[name] = threading.BoundedSemaphore(workers)
+        return _executors[name]
+
+
+def try_submit(name, fn, *args):
+    """Run `fn(*args)` in the thread pool `name` if one of its threads is
+    free, and return its future. Returns None (and does not queue the call)
+    if all threads are busy.
+    """
+    executor = get_executor(name)
+    slots = _executor_slots[name]
+    if not slots.acquire(blocking=False):
+        return None
+
+    def run():
+        try:
+            return fn(*args)
+        finally:
+            slots.release()
+
+    return executor.submit(run)
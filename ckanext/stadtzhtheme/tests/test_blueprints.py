@@ -0,0 +1,283 @@
+import hashlib
+from datetime import datetime, timezone
+
+import pytest
+from ckan.tests import factories, helpers
+
+from ckanext.stadtzhtheme import blueprints, downloads, jobs
+from ckanext.stadtzhtheme import logic as ogdzh_logic
+from ckanext.stadtzhtheme import storage
+from ckanext.stadtzhtheme.cache import clear_caches
+
+
+@pytest.mark.ckan_config("ckan.plugins", "stadtzhtheme showcase")
+@pytest.mark.usefixtures("with_plugins")
+class TestSuggestEndpoint(object):
+    @pytest.fixture(autouse=True)
+    def fake_suggestions(self, monkeypatch):
+        monkeypatch.setattr(
+            ogdzh_logic, "get_suggestions", lambda q, cfq="": ["Velofahrten"]
+        )
+
+    def test_suggest(self, app):
+        resp = app.get("/api/ogdzh/suggest", query_string={"q": "velo"})
+
+        assert resp.json == ["Velofahrten"]
+        assert resp.headers["ETag"] == '"%s"' % hashlib.sha1(resp.data).hexdigest()
+        assert resp.headers["Cache-Control"] == "public, max-age=300"
+
+    def test_suggest_not_modified(self, app):
+        etag = app.get("/api/ogdzh/suggest", query_string={"q": "velo"}).headers["ETag"]
+        resp = app.get(
+            "/api/ogdzh/suggest",
+            query_string={"q": "velo"},
+            headers={"If-None-Match": etag},
+            status=304,
+        )
+
+        assert not resp.data
+
+    def test_etag_changes_with_suggestions(self, app, monkeypatch):
+        etag = app.get("/api/ogdzh/suggest", query_string={"q": "velo"}).headers["ETag"]
+        monkeypatch.setattr(
+            ogdzh_logic, "get_suggestions", lambda q, cfq="": ["Velozählung"]
+        )
+
+        resp = app.get(
+            "/api/ogdzh/suggest",
+            query_string={"q": "velo"},
+            headers={"If-None-Match": etag},
+        )
+
+        assert resp.json == ["Velozählung"]
+        assert resp.headers["ETag"] != etag
+
+    def test_suggest_without_q(self, app):
+        app.get("/api/ogdzh/suggest", status=400)
+
+
+@pytest.mark.ckan_config("ckan.plugins", "stadtzhtheme showcase")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestResourcePermalink(object):
+    def setup_method(self):
+        clear_caches()
+
+    def test_link_resource_is_redirected(self, app):
+        dataset = factories.Dataset()
+        factories.Resource(
+            package_id=dataset["id"], name="velo.csv", url="http://example.com/velo.csv"
+        )
+
+        resp = app.get(
+            "/dataset/%s/download/velo.csv" % dataset["name"], follow_redirects=False
+        )
+
+        assert resp.status_code == 302
+        assert resp.headers["Location"] == "http://example.com/velo.csv"
+        assert resp.headers["Cache-Control"] == "public, max-age=60"
+
+    def test_updated_resource_is_found(self, app):
+        dataset = factories.Dataset()
+        resource = factories.Resource(
+            package_id=dataset["id"], name="velo.csv", url="http://example.com/velo.csv"
+        )
+        url = "/dataset/%s/download/velo.csv" % dataset["name"]
+        app.get(url, follow_redirects=False)
+
+        helpers.call_action(
+            "resource_patch", id=resource["id"], url="http://example.com/velo2.csv"
+        )
+        resp = app.get(url, follow_redirects=False)
+
+        assert resp.headers["Location"] == "http://example.com/velo2.csv"
+
+    def test_unknown_resource(self, app):
+        dataset = factories.Dataset()
+
+        app.get("/dataset/%s/download/velo.csv" % dataset["name"], status=404)
+
+    def test_private_dataset(self, app):
+        dataset = factories.Dataset(
+            private=True, owner_org=factories.Organization()["id"]
+        )
+        factories.Resource(
+            package_id=dataset["id"], name="velo.csv", url="http://example.com/velo.csv"
+        )
+
+        app.get("/dataset/%s/download/velo.csv" % dataset["name"], status=403)
+
+    def test_private_dataset_hides_resource_names(self, app):
+        dataset = factories.Dataset(
+            private=True, owner_org=factories.Organization()["id"]
+        )
+
+        app.get("/dataset/%s/download/unknown.csv" % dataset["name"], status=403)
+
+
+class TestS3FilestoreRedirect(object):
+    def test_s3filestore_is_detected_once(self, monkeypatch):
+        monkeypatch.setattr(jobs, "_s3filestore", False)
+
+        jobs.detect_s3filestore({"ckan.plugins": "stadtzhtheme s3filestore"})
+
+        assert jobs.uses_s3filestore()
+
+    @pytest.mark.ckan_config("ckan.site_url", "http://stadtzh.lo")
+    def test_upload_is_redirected(self, monkeypatch):
+        monkeypatch.setattr(jobs, "_s3filestore", True)
+        rsc = {"id": "abc", "url_type": "upload", "filename": "velo.csv"}
+
+        url = blueprints._get_redirect_url("velo", "Velofahrten", rsc)
+
+        assert url == "http://stadtzh.lo/dataset/velo/resource/abc/download/velo.csv"
+
+    def test_upload_is_sent_without_s3filestore(self, monkeypatch):
+        monkeypatch.setattr(jobs, "_s3filestore", False)
+        rsc = {"id": "abc", "url_type": "upload", "filename": "velo.csv"}
+
+        assert blueprints._get_redirect_url("velo", "Velofahrten", rsc) is None
+
+
+class TestDownloadOffload(object):
+    @pytest.mark.ckan_config("ckan.storage_path", "/var/lib/ckan/default")
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.download_offload_prefix", "/internal/storage/"
+    )
+    def test_offload_uri(self):
+        uri = blueprints._offload_uri(
+            "/var/lib/ckan/default/resources/0e5/4a1/c8b-0b5e-4ed1-a4b8-1f5c44bd4bd1"
+        )
+
+        assert uri == (
+            "/internal/storage/resources/0e5/4a1/c8b-0b5e-4ed1-a4b8-1f5c44bd4bd1"
+        )
+
+    @pytest.mark.ckan_config("ckan.storage_path", "/var/lib/ckan/default")
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.download_offload", "x-accel-redirect"
+    )
+    def test_x_accel_redirect(self, tmp_path, with_request_context):
+        # the file is outside of the storage path, only the header matters here
+        filepath = tmp_path / "velo.csv"
+        filepath.write_text("a,b\n1,2\n")
+
+        resp = blueprints._send_upload(str(filepath), "velo.csv")
+
+        assert resp.headers["X-Accel-Redirect"].startswith("/_storage/")
+        assert resp.headers["X-Accel-Redirect"].endswith("/velo.csv")
+        assert "X-Sendfile" not in resp.headers
+        assert resp.headers["Content-Type"].startswith("text/csv")
+
+
+class TestConditionalDownload(object):
+    def test_download_validators(self):
+        etag, last_modified = blueprints._get_download_validators(
+            {"hash": "abc", "zh_hash": "def", "last_modified": "2024-03-01T10:20:30.5"}
+        )
+
+        assert etag == "def"
+        assert last_modified == datetime(2024, 3, 1, 10, 20, 30, tzinfo=timezone.utc)
+
+    def test_download_validators_with_offset(self):
+        etag, last_modified = blueprints._get_download_validators(
+            {"last_modified": "2024-03-01T12:20:30.123+02:00"}
+        )
+
+        assert etag is None
+        assert last_modified == datetime(2024, 3, 1, 10, 20, 30, tzinfo=timezone.utc)
+
+    def test_not_modified_by_etag(self, app):
+        last_modified = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        with app.flask_app.test_request_context(headers={"If-None-Match": '"abc"'}):
+            assert blueprints._is_not_modified("abc", last_modified)
+            assert not blueprints._is_not_modified("def", last_modified)
+            assert not blueprints._is_not_modified(None, last_modified)
+
+    def test_not_modified_since(self, app):
+        last_modified = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        headers = {"If-Modified-Since": "Fri, 01 Mar 2024 00:00:00 GMT"}
+        with app.flask_app.test_request_context(headers=headers):
+            assert blueprints._is_not_modified(None, last_modified)
+            assert not blueprints._is_not_modified(
+                None, datetime(2024, 3, 2, tzinfo=timezone.utc)
+            )
+
+    def test_range_request(self, app, tmp_path):
+        filepath = tmp_path / "velo.csv"
+        filepath.write_text("a,b\n1,2\n")
+
+        with app.flask_app.test_request_context(headers={"Range": "bytes=0-2"}):
+            resp = blueprints._send_upload(str(filepath), "velo.csv", etag="abc")
+            resp.direct_passthrough = False
+
+            assert resp.status_code == 206
+            assert resp.get_data() == b"a,b"
+            assert resp.headers["ETag"] == '"abc"'
+
+
+class TestDownloadCount(object):
+    @pytest.fixture
+    def counted(self, tmp_path, monkeypatch):
+        filepath = tmp_path / "velo.csv"
+        filepath.write_text("a,b\n1,2\n")
+        monkeypatch.setattr(blueprints, "_get_upload_path", lambda rsc: str(filepath))
+        counted = []
+        monkeypatch.setattr(downloads, "count_download", counted.append)
+        return counted
+
+    @pytest.mark.parametrize(
+        "headers,count",
+        [
+            ({}, 1),
+            ({"Range": "bytes=0-2"}, 1),
+            ({"Range": "bytes=0-2, 4-6"}, 1),
+            ({"Range": "bytes=3-"}, 0),
+            ({"Range": "bytes=-3"}, 0),
+        ],
+    )
+    def test_range_requests(self, app, counted, headers, count):
+        rsc = {"id": "1", "url_type": "upload", "format": "CSV"}
+        with app.flask_app.test_request_context(headers=headers):
+            blueprints._download_upload(rsc, "velo.csv")
+
+        assert counted == ["1"] * count
+
+
+class TestPrecompressedDownload(object):
+    @pytest.fixture
+    def upload(self, tmp_path, monkeypatch):
+        filepath = str(tmp_path / "velo.csv")
+        with open(filepath, "w") as f:
+            f.write("a,b\n1,2\n" * 1000)
+        storage.write_variant(filepath, "gzip")
+        monkeypatch.setattr(blueprints, "_get_upload_path", lambda rsc: filepath)
+        return {"id": "1", "url_type": "upload", "format": "CSV", "hash": "abc"}
+
+    def test_gzip_variant(self, app, upload):
+        headers = {"Accept-Encoding": "gzip, deflate"}
+        with app.flask_app.test_request_context(headers=headers):
+            resp = blueprints._download_upload(upload, "velo.csv")
+
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert resp.headers["ETag"] == '"abc-gzip"'
+            assert "Accept-Encoding" in resp.vary
+
+    def test_identity(self, app, upload):
+        with app.flask_app.test_request_context():
+            resp = blueprints._download_upload(upload, "velo.csv")
+
+            assert "Content-Encoding" not in resp.headers
+            assert resp.headers["ETag"] == '"abc"'
+            assert "Accept-Encoding" in resp.vary
+
+
+class TestCachedResponse(object):
+    def test_cache_control_is_fixed(self):
+        resp = blueprints.CachedResponse("")
+        resp.set_cache_control("public, max-age=300")
+
+        # like CKAN does after every request
+        resp.cache_control.max_age = 0
+        resp.cache_control.must_revalidate = True
+
+        assert resp.headers["Cache-Control"] == "public, max-age=300"
@@ -0,0 +1,89 @@
+import sqlalchemy as sa
+from ckan import model
+
+from ckanext.stadtzhtheme import cache
+
+
+class TestTTLCache(object):
+    def test_get_and_set(self):
+        ttl_cache = cache.TTLCache(ttl=60)
+        assert ttl_cache.get("key") is None
+        ttl_cache.set("key", "value")
+        assert ttl_cache.get("key") == "value"
+        assert ttl_cache.stats()["hits"] == 1
+        assert ttl_cache.stats()["misses"] == 1
+
+    def test_expiry(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+        ttl_cache = cache.TTLCache(ttl=60)
+        ttl_cache.set("key", "value")
+
+        now[0] += 59
+        assert ttl_cache.get("key") == "value"
+        now[0] += 2
+        assert ttl_cache.get("key") is None
+        assert len(ttl_cache) == 0
+
+    def test_lru_eviction(self):
+        ttl_cache = cache.TTLCache(ttl=0, maxsize=2)
+        ttl_cache.set("a", 1)
+        ttl_cache.set("b", 2)
+        ttl_cache.get("a")
+        ttl_cache.set("c", 3)
+
+        assert ttl_cache.get("a") == 1
+        assert ttl_cache.get("b") is None
+        assert ttl_cache.get("c") == 3
+
+    def test_invalidate(self):
+        ttl_cache = cache.TTLCache()
+        ttl_cache.set("a", 1)
+        ttl_cache.set("b", 2)
+
+        ttl_cache.invalidate("a")
+        assert ttl_cache.get("a") is None
+        assert ttl_cache.get("b") == 2
+
+        ttl_cache.invalidate()
+        assert len(ttl_cache) == 0
+
+    def test_get_or_set(self):
+        ttl_cache = cache.TTLCache()
+        calls = []
+
+        def factory():
+            calls.append(1)
+            return "value"
+
+        assert ttl_cache.get_or_set("key", factory) == "value"
+        assert ttl_cache.get_or_set("key", factory) == "value"
+        assert len(calls) == 1
+
+
+class TestInvalidateAfterCommit(object):
+    def setup_method(self):
+        cache.clear_caches()
+        cache.get_cache("velo").set("key", "value")
+
+    def teardown_method(self):
+        model.Session.remove()
+
+    def test_without_transaction(self):
+        cache.invalidate_after_commit("velo")
+        assert cache.get_cache("velo").get("key") is None
+
+    def test_commit(self):
+        model.Session.execute(sa.text("SELECT 1"))
+        cache.invalidate_after_commit("velo")
+        assert cache.get_cache("velo").get("key") == "value"
+
+        model.Session.commit()
+        assert cache.get_cache("velo").get("key") is None
+
+    def test_rollback(self):
+        model.Session.execute(sa.text("SELECT 1"))
+        cache.invalidate_after_commit("velo")
+
+        model.Session.rollback()
+        assert cache.get_cache("velo").get("key") is None
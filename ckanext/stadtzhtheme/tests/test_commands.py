@@ -0,0 +1,166 @@
+import os
+import time
+
+import pytest
+from ckan.tests import factories, helpers
+from click.testing import CliRunner
+
+from ckanext.stadtzhtheme import commands
+
+ACTIVE_ID = "0e54a1c8-0b5e-4ed1-a4b8-1f5c44bd4bd1"
+SIBLING_ID = "0e54a1f2-6f0d-4c1e-9d5b-7a2f3c1e8b90"
+ORPHAN_ID = "7c9d2e41-3b6a-4f8e-a1d0-5e2b9c7f4a63"
+
+
+def _store(root, resource_id, suffix=""):
+    """Write a resource file like the uploader does, with an optional suffix
+    of a precompressed variant.
+    """
+    dir_path = root / resource_id[0:3] / resource_id[3:6]
+    dir_path.mkdir(parents=True, exist_ok=True)
+    path = dir_path / (resource_id[6:] + suffix)
+    path.write_text("a,b\n1,2\n")
+    return path
+
+
+def _counts():
+    return {"kept": 0, "deleted_files": 0, "deleted_dirs": 0}
+
+
+class TestCleanupFilestore(object):
+    def test_orphaned_files_and_variants_are_deleted(self, tmp_path):
+        active = _store(tmp_path, ACTIVE_ID)
+        active_gzip = _store(tmp_path, ACTIVE_ID, ".gz")
+        orphan = _store(tmp_path, SIBLING_ID)
+        orphan_brotli = _store(tmp_path, SIBLING_ID, ".br")
+        counts = _counts()
+
+        commands._cleanup_storage_dir(str(tmp_path), {ACTIVE_ID}, counts, is_root=True)
+
+        assert active.exists()
+        assert active_gzip.exists()
+        assert not orphan.exists()
+        assert not orphan_brotli.exists()
+        assert counts == {"kept": 2, "deleted_files": 2, "deleted_dirs": 0}
+
+    def test_empty_directories_are_pruned(self, tmp_path):
+        active = _store(tmp_path, ACTIVE_ID)
+        _store(tmp_path, ORPHAN_ID)
+        (tmp_path / "abc" / "def").mkdir(parents=True)
+        counts = _counts()
+
+        commands._cleanup_storage_dir(str(tmp_path), {ACTIVE_ID}, counts, is_root=True)
+
+        assert active.exists()
+        assert not (tmp_path / ORPHAN_ID[0:3]).exists()
+        assert not (tmp_path / "abc").exists()
+        assert sorted(p.name for p in tmp_path.iterdir()) == [ACTIVE_ID[0:3]]
+        assert counts == {"kept": 1, "deleted_files": 1, "deleted_dirs": 4}
+
+    def test_root_is_never_removed(self, tmp_path):
+        root = tmp_path / "resources"
+        _store(root, ORPHAN_ID)
+        _store(root, ORPHAN_ID, ".gz")
+        counts = _counts()
+
+        commands._cleanup_storage_dir(str(root), set(), counts, is_root=True)
+
+        assert root.is_dir()
+        assert list(root.iterdir()) == []
+        assert counts == {"kept": 0, "deleted_files": 2, "deleted_dirs": 2}
+
+    def test_files_written_after_the_start_are_kept(self, tmp_path):
+        old = _store(tmp_path, ORPHAN_ID)
+        os.utime(old, (1000, 1000))
+        os.utime(old.parent, (1000, 1000))
+        os.utime(old.parent.parent, (1000, 1000))
+        new = _store(tmp_path, SIBLING_ID)
+        counts = _counts()
+
+        commands._cleanup_storage_dir(
+            str(tmp_path), set(), counts, is_root=True, started=time.time() - 60
+        )
+
+        assert not old.exists()
+        assert new.exists()
+        assert counts == {"kept": 1, "deleted_files": 1, "deleted_dirs": 2}
+
+
+@pytest.mark.ckan_config("ckan.plugins", "stadtzhtheme showcase")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestCleanupDatastore(object):
+    def test_active_resource_ids(self):
+        dataset = factories.Dataset()
+        active = factories.Resource(package_id=dataset["id"])
+        deleted = factories.Resource(package_id=dataset["id"])
+        helpers.call_action("resource_delete", id=deleted["id"])
+
+        assert commands._get_active_resource_ids() == {active["id"]}
+
+    def test_orphaned_tables(self, monkeypatch):
+        active = factories.Resource()
+        deleted = factories.Resource()
+        helpers.call_action("resource_delete", id=deleted["id"])
+        monkeypatch.setattr(commands.logic, "check_access", lambda *args: True)
+        monkeypatch.setattr(
+            commands,
+            "_get_datastore_table_names",
+            lambda context: {active["id"], deleted["id"], ORPHAN_ID},
+        )
+
+        result = CliRunner().invoke(
+            commands.stadtzhtheme, ["cleanup_datastore", "--dry-run"]
+        )
+
+        assert result.exit_code == 0, result.output
+        assert "2 orphaned tables found" in result.output
+        assert "- %s" % deleted["id"] in result.output
+        assert "- %s" % ORPHAN_ID in result.output
+        assert active["id"] not in result.output
+
+
+@pytest.mark.ckan_config("ckan.plugins", "stadtzhtheme showcase image_view")
+@pytest.mark.ckan_config("ckan.views.default_views", "image_view")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "with_request_context")
+class TestEnsureViews(object):
+    @pytest.fixture
+    def resource(self):
+        """An image resource whose default view has gone missing."""
+        resource = factories.Resource(url="http://example.com/velo.png", format="PNG")
+        for view in helpers.call_action("resource_view_list", id=resource["id"]):
+            helpers.call_action("resource_view_delete", id=view["id"])
+        return resource
+
+    def _view_types(self, resource):
+        views = helpers.call_action("resource_view_list", id=resource["id"])
+        return [view["view_type"] for view in views]
+
+    def test_dry_run(self, resource):
+        result = CliRunner().invoke(
+            commands.stadtzhtheme, ["ensure_views", "--dry-run"]
+        )
+
+        assert result.exit_code == 0, result.output
+        assert (
+            "- missing view 'image_view' for resource %s" % resource["id"]
+            in result.output
+        )
+        assert "Processed 1/1 datasets" in result.output
+        assert "1 views are missing" in result.output
+        assert self._view_types(resource) == []
+
+    def test_missing_views_are_created(self, resource):
+        factories.Dataset()
+
+        result = CliRunner().invoke(
+            commands.stadtzhtheme, ["ensure_views", "--batch-size", "1"]
+        )
+
+        assert result.exit_code == 0, result.output
+        assert (
+            "- created view 'image_view' for resource %s" % resource["id"]
+            in result.output
+        )
+        assert "Processed 2/2 datasets" in result.output
+        assert "1 views were created" in result.output
+        assert self._view_types(resource) == ["image_view"]
@@ -0,0 +1,53 @@
+import time
+
+from ckanext.stadtzhtheme import downloads
+
+
+class TestDownloadCounter(object):
+    def test_counts_are_buffered(self, tmp_path):
+        path = str(tmp_path / "download_stats.jsonl")
+        counter = downloads.DownloadCounter(path, interval=3600)
+        counter.add("1")
+        counter.add("1")
+        counter.add("2")
+
+        assert downloads.read_counts(path) == {}
+
+        counter.flush()
+        counter.add("1")
+        counter.flush()
+
+        assert downloads.read_counts(path) == {"1": 3, "2": 1}
+
+    def test_counts_are_flushed_in_the_background(self, tmp_path):
+        path = str(tmp_path / "download_stats.jsonl")
+        counter = downloads.DownloadCounter(path, interval=0.01)
+        counter.start()
+        try:
+            # counted once and never again, there is no later download
+            counter.add("1")
+
+            for i in range(50):
+                if downloads.read_counts(path):
+                    break
+                time.sleep(0.01)
+        finally:
+            counter.stop()
+        assert downloads.read_counts(path) == {"1": 1}
+
+    def test_counts_are_kept_if_writing_fails(self, tmp_path):
+        path = str(tmp_path / "missing" / "download_stats.jsonl")
+        counter = downloads.DownloadCounter(path, interval=3600)
+        counter.add("1")
+        counter.flush()
+
+        (tmp_path / "missing").mkdir()
+        counter.flush()
+
+        assert downloads.read_counts(path) == {"1": 1}
+
+    def test_invalid_lines_are_skipped(self, tmp_path):
+        path = tmp_path / "download_stats.jsonl"
+        path.write_text('{"counts": {"1": 2}}\nnot json\n{"counts": {"1": 1}}\n')
+
+        assert downloads.read_counts(str(path)) == {"1": 3}
@@ -0,0 +1,233 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ckan.plugins.toolkit as tk
+import pytest
+from ckan.logic import ActionError
+
+from ckanext.stadtzhtheme import cache, logic, metrics
+from ckanext.stadtzhtheme.cache import clear_caches
+
+
+@pytest.fixture
+def solr_suggestions(monkeypatch):
+    """Replace the solr lookup with a fake one that records its calls."""
+    calls = []
+    suggestions = [
+        {"term": "Velofahrten", "weight": 10},
+        {"term": "Velozählung", "weight": 5},
+        {"term": "Verkehr", "weight": 3},
+    ]
+
+    def load_suggestions(q, cfq, suggest_count):
+        calls.append(q)
+        matching = [s for s in suggestions if s["term"].lower().startswith(q)]
+        return matching, True
+
+    clear_caches()
+    monkeypatch.setattr(logic, "_load_suggestions", load_suggestions)
+    return calls
+
+
+class TestAutosuggestRanking(object):
+    def test_top_terms(self):
+        suggestions = [
+            {"term": "Velo", "weight": 1},
+            {"term": "Verkehr", "weight": 5},
+            {"term": "Velo", "weight": 7},
+            {"term": "Bevölkerung", "weight": 5},
+            {"term": "Abfall", "weight": 2},
+        ]
+
+        assert logic.top_terms(suggestions, 3) == ["Velo", "Bevölkerung", "Verkehr"]
+
+    def test_suggest_count_is_adapted(self, monkeypatch):
+        counts = []
+
+        def load_suggestions(q, cfq, suggest_count):
+            counts.append(suggest_count)
+            # every term is suggested four times
+            suggestions = [
+                {"term": "term %s" % (i // 4), "weight": 100 - i}
+                for i in range(suggest_count)
+            ]
+            return suggestions, False
+
+        clear_caches()
+        monkeypatch.setattr(logic, "_load_suggestions", load_suggestions)
+
+        terms = logic.get_suggestions("term")
+
+        assert counts == [20, 40]
+        assert terms == ["term %s" % i for i in range(10)]
+
+
+class TestAutosuggestCache(object):
+    def test_suggestions_are_cached(self, solr_suggestions):
+        first = logic.get_suggestions("velo")
+        second = logic.get_suggestions("  VELO ")
+
+        assert sorted(first) == ["Velofahrten", "Velozählung"]
+        assert sorted(second) == sorted(first)
+        assert solr_suggestions == ["velo"]
+
+    def test_context_is_part_of_the_key(self, solr_suggestions):
+        logic.get_suggestions("velo")
+        logic.get_suggestions("velo", "geodaten")
+
+        assert solr_suggestions == ["velo", "velo"]
+
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.ogdzh_autosuggest_prefix_reuse", "true"
+    )
+    def test_prefix_reuse(self, solr_suggestions):
+        logic.get_suggestions("ve")
+        terms = logic.get_suggestions("velo")
+
+        assert sorted(terms) == ["Velofahrten", "Velozählung"]
+        assert solr_suggestions == ["ve"]
+
+    def test_no_prefix_reuse_by_default(self, solr_suggestions):
+        logic.get_suggestions("ve")
+        logic.get_suggestions("velo")
+
+        assert solr_suggestions == ["ve", "velo"]
+
+
+class TestAutosuggestBatch(object):
+    def test_results_in_order_of_queries(self, solr_suggestions):
+        result = logic.ogdzh_autosuggest_batch(
+            {}, {"queries": '[{"q": "velo"}, {"q": "verk", "cfq": "geodaten"}]'}
+        )
+
+        assert len(result) == 2
+        assert sorted(result[0]) == ["Velofahrten", "Velozählung"]
+        assert result[1] == ["Verkehr"]
+
+    @pytest.mark.parametrize(
+        "queries",
+        [
+            [{"cfq": "geodaten"}],
+            [{"q": 5}],
+            [{"q": "  "}],
+            [{"q": "velo", "cfq": ["geodaten"]}],
+            '[{"q": "velo", "cfq": null}]',
+            ["velo"],
+        ],
+    )
+    def test_invalid_queries(self, solr_suggestions, queries):
+        with pytest.raises(tk.ValidationError):
+            logic.ogdzh_autosuggest_batch({}, {"queries": queries})
+
+    @pytest.mark.ckan_config("ckanext.stadtzhtheme.ogdzh_autosuggest_batch_limit", "1")
+    def test_batch_limit(self, solr_suggestions):
+        with pytest.raises(tk.ValidationError):
+            logic.ogdzh_autosuggest_batch({}, {"queries": [{"q": "a"}, {"q": "b"}]})
+
+
+class TestAutosuggestSuggesters(object):
+    @pytest.fixture
+    def suggesters(self, monkeypatch):
+        suggestions = {
+            "titles": [{"term": "Velofahrten", "weight": 10}],
+            "tags": [
+                {"term": "velo", "weight": 12},
+                {"term": "Velofahrten", "weight": 2},
+            ],
+        }
+
+        def load_suggester_suggestions(suggester, q, cfq, suggest_count, timeout):
+            if suggester == "slow":
+                # like a solr request that runs into its timeout
+                time.sleep(min(3, timeout))
+                raise ActionError("Error retrieving suggestions from solr")
+            if suggester == "broken":
+                raise ActionError("Error retrieving suggestions from solr")
+            if suggester == "missing":
+                raise KeyError(suggester)
+            return suggestions.get(suggester, []), True
+
+        clear_caches()
+        monkeypatch.setattr(
+            logic, "_load_suggester_suggestions", load_suggester_suggestions
+        )
+
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.ogdzh_autosuggest_suggesters", "titles tags"
+    )
+    def test_suggestions_are_merged(self, suggesters):
+        assert logic.get_suggestions("velo") == ["velo", "Velofahrten"]
+
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.ogdzh_autosuggest_suggesters",
+        "titles slow broken missing",
+    )
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.ogdzh_autosuggest_suggester_timeout", "0.1"
+    )
+    def test_slow_and_failing_suggesters_are_left_out(self, suggesters):
+        suggestions, complete = logic._load_solr_suggestions("velo", "active", 20)
+
+        assert suggestions == [{"term": "Velofahrten", "weight": 10}]
+        assert not complete
+
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.ogdzh_autosuggest_suggesters", "broken slow"
+    )
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.ogdzh_autosuggest_suggester_timeout", "0.1"
+    )
+    def test_no_suggester_answers(self, suggesters):
+        with pytest.raises(ActionError):
+            logic._load_solr_suggestions("velo", "active", 20)
+
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.ogdzh_autosuggest_suggesters", "slow titles"
+    )
+    @pytest.mark.ckan_config(
+        "ckanext.stadtzhtheme.ogdzh_autosuggest_suggester_timeout", "0.2"
+    )
+    def test_busy_pool_does_not_block_other_suggesters(self, suggesters):
+        # more concurrent requests than the pool has threads
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(logic._load_solr_suggestions, "velo", "active", 20)
+                for i in range(8)
+            ]
+            results = [future.result() for future in futures]
+
+        assert all(
+            suggestions == [{"term": "Velofahrten", "weight": 10}]
+            for suggestions, complete in results
+        )
+
+
+class TestAutosuggestMetrics(object):
+    def test_suggestions_are_measured(self, solr_suggestions):
+        metrics.reset()
+        logic.get_suggestions("velo")
+        logic.get_suggestions("velo")
+
+        result = logic.ogdzh_autosuggest_metrics({"ignore_auth": True}, {})
+
+        histograms = result["histograms"]
+        assert histograms["autosuggest_latency_seconds"]["count"] == 2
+        assert histograms["autosuggest_result_size"]["buckets"]["2"] == 2
+        assert result["caches"]["autosuggest"]["hits"] == 1
+        assert result["caches"]["autosuggest"]["misses"] == 1
+
+
+class TestCacheStats(object):
+    def test_caches_are_reported(self, monkeypatch):
+        clear_caches()
+        monkeypatch.setattr(cache, "_package_show_stats", {"hits": 3, "misses": 1})
+        cache.get_cache("velo").set("key", "value")
+
+        result = logic.ogdzh_cache_stats({"ignore_auth": True}, {})
+
+        assert result["velo"]["size"] == 1
+        assert result["package_show"] == {
+            "hits": 3,
+            "misses": 1,
+            "hit_rate": 0.75,
+        }
@@ -0,0 +1,32 @@
+from ckanext.stadtzhtheme import metrics
+
+
+class TestMetrics(object):
+    def setup_method(self):
+        metrics.reset()
+
+    def test_histogram(self):
+        histogram = metrics.Histogram([1, 5, 10])
+        for value in (0, 1, 3, 7, 50):
+            histogram.observe(value)
+
+        snapshot = histogram.snapshot()
+        assert snapshot["buckets"] == {"1": 2, "5": 1, "10": 1, "+Inf": 1}
+        assert snapshot["count"] == 5
+        assert snapshot["sum"] == 61
+
+    def test_counters_and_timings(self):
+        metrics.increment("errors")
+        metrics.increment("errors", 2)
+        with metrics.timed("latency"):
+            pass
+
+        snapshot = metrics.snapshot()
+        assert snapshot["counters"] == {"errors": 3}
+        assert snapshot["histograms"]["latency"]["count"] == 1
+
+    def test_reset(self):
+        metrics.increment("errors")
+        metrics.reset()
+
+        assert metrics.snapshot() == {"counters": {}, "histograms": {}}
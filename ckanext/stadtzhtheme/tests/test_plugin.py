@@ -5,6 +5,11 @@ from ckan.lib.helpers import url_for
 from ckan.tests import factories, helpers
 
 import ckanext.stadtzhtheme.plugin as plugin
+from ckanext.stadtzhtheme.cache import (
+    cached_package_show,
+    clear_caches,
+    package_show_stats,
+)
 
 
 @pytest.mark.ckan_config("ckan.plugins", "stadtzhtheme showcase")
@@ -190,3 +195,91 @@ class TestPlugin(object):
         assert "SQL" in resource_csv.get("markdown_snippet")
         assert download_url_encoded in resource_csv.get("markdown_snippet")
         assert download_url not in resource_csv.get("markdown_snippet")
+
+    @pytest.mark.usefixtures("clean_db")
+    def test_vocabulary_cache_invalidated_on_tag_create(self):
+        clear_caches()
+        plugin._bootstrapped_vocabularies.clear()
+
+        assert "jaehrlich" in plugin.updateInterval()
+
+        vocab = helpers.call_action("vocabulary_show", id="updateInterval")
+        helpers.call_action(
+            "tag_create", name="zweijaehrlich", vocabulary_id=vocab["id"]
+        )
+        assert "zweijaehrlich" in plugin.updateInterval()
+
+    @pytest.mark.usefixtures("clean_db", "clean_index")
+    def test_biggest_groups_updated_after_dataset_create(self):
+        clear_caches()
+        small_group = factories.Group()
+        big_group = factories.Group()
+        factories.Dataset(groups=[{"name": big_group["name"]}])
+
+        assert [g["name"] for g in plugin.biggest_groups(1)] == [big_group["name"]]
+
+        factories.Dataset(groups=[{"name": small_group["name"]}])
+        factories.Dataset(groups=[{"name": small_group["name"]}])
+
+        assert [g["name"] for g in plugin.biggest_groups(2)] == [
+            small_group["name"],
+            big_group["name"],
+        ]
+
+    @pytest.mark.usefixtures("with_request_context")
+    def test_package_show_cached_for_request(self):
+        dataset = factories.Dataset(title="Original title")
+        context = {"user": ""}
+        hits = package_show_stats()["hits"]
+
+        cached_package_show(context, dataset["id"])
+        cached = cached_package_show(context, dataset["id"])
+        assert cached["title"] == "Original title"
+        assert package_show_stats()["hits"] == hits + 1
+
+        helpers.call_action("package_patch", id=dataset["id"], title="New title")
+        assert cached_package_show(context, dataset["id"])["title"] == "New title"
+
+
+@pytest.mark.ckan_config("ckan.plugins", "stadtzhtheme showcase image_view")
+@pytest.mark.ckan_config("ckan.views.default_views", "image_view")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestResourceViews(object):
+    def _view_types(self, resource):
+        views = helpers.call_action("resource_view_list", id=resource["id"])
+        return [view["view_type"] for view in views]
+
+    def _delete_views(self, resource):
+        for view in helpers.call_action("resource_view_list", id=resource["id"]):
+            helpers.call_action("resource_view_delete", id=view["id"])
+
+    def test_dataset_page_does_no_write_work(self, app, monkeypatch):
+        dataset = factories.Dataset()
+        resource = factories.Resource(
+            package_id=dataset["id"], url="http://example.com/velo.png", format="PNG"
+        )
+        self._delete_views(resource)
+        clear_caches()
+        ensured = []
+        monkeypatch.setattr(
+            plugin.StadtzhThemePlugin,
+            "_ensure_resource_views",
+            lambda self, resource, *args, **kwargs: ensured.append(resource["id"]),
+        )
+
+        app.get(url_for("dataset.read", id=dataset["name"]))
+
+        assert ensured == []
+        assert self._view_types(resource) == []
+
+    def test_views_are_created_on_resource_writes(self):
+        clear_caches()
+        resource = factories.Resource(url="http://example.com/velo.png", format="PNG")
+        assert self._view_types(resource) == ["image_view"]
+
+        self._delete_views(resource)
+        helpers.call_action(
+            "resource_patch", id=resource["id"], url="http://example.com/velo2.png"
+        )
+
+        assert self._view_types(resource) == ["image_view"]
@@ -0,0 +1,126 @@
+import gzip
+import os
+
+import ckan.lib.uploader as uploader
+import pytest
+
+from ckanext.stadtzhtheme import jobs, storage
+
+
+def _create_resource_file(resource_path, resource_id, content):
+    dir_path = resource_path / resource_id[0:3] / resource_id[3:6]
+    dir_path.mkdir(parents=True, exist_ok=True)
+    file_path = dir_path / resource_id[6:]
+    file_path.write_bytes(content)
+    return str(file_path)
+
+
+class TestStorage(object):
+    def test_iter_storage_files(self, tmp_path):
+        _create_resource_file(tmp_path, "abcdef-111", b"a")
+        _create_resource_file(tmp_path, "abcxyz-222", b"b")
+
+        resource_ids = sorted(
+            r for r, entry in storage.iter_storage_files(str(tmp_path))
+        )
+        assert resource_ids == ["abcdef-111", "abcxyz-222"]
+
+    def test_find_duplicates(self, tmp_path):
+        first = _create_resource_file(tmp_path, "abcdef-111", b"same content")
+        second = _create_resource_file(tmp_path, "abcxyz-222", b"same content")
+        _create_resource_file(tmp_path, "defabc-333", b"other content")
+        _create_resource_file(tmp_path, "defxyz-444", b"x")
+
+        files = [
+            (entry.path, entry.stat())
+            for r, entry in storage.iter_storage_files(str(tmp_path))
+        ]
+        duplicates = storage.find_duplicates(files)
+
+        assert len(duplicates) == 1
+        assert duplicates[0].size == len(b"same content")
+        assert duplicates[0].paths == sorted([first, second])
+        assert duplicates[0].digest == storage.file_hash(first)
+        assert duplicates[0].inodes == 2
+
+    def test_find_duplicates_ignores_hard_links(self, tmp_path):
+        first = _create_resource_file(tmp_path, "abcdef-111", b"same content")
+        second = str(tmp_path / "abc" / "def" / "-222")
+        os.link(first, second)
+
+        files = [(path, os.stat(path)) for path in (first, second)]
+
+        assert storage.find_duplicates(files) == []
+
+    def test_link_and_unlink_duplicate(self, tmp_path):
+        first = _create_resource_file(tmp_path, "abcdef-111", b"same content")
+        second = _create_resource_file(tmp_path, "abcxyz-222", b"same content")
+
+        assert storage.link_duplicate(first, second)
+        assert os.stat(first).st_ino == os.stat(second).st_ino
+
+        storage.unlink_duplicate(second)
+        assert os.stat(first).st_ino != os.stat(second).st_ino
+        with open(second, "rb") as f:
+            assert f.read() == b"same content"
+
+    def test_link_duplicate_with_different_content(self, tmp_path):
+        first = _create_resource_file(tmp_path, "abcdef-111", b"content")
+        second = _create_resource_file(tmp_path, "abcxyz-222", b"changed")
+
+        assert not storage.link_duplicate(first, second)
+        assert os.stat(first).st_ino != os.stat(second).st_ino
+
+    def test_variants_belong_to_their_resource(self, tmp_path):
+        path = _create_resource_file(tmp_path, "abcdef-111", b"a,b\n" * 1000)
+        storage.write_variant(path, "gzip")
+
+        resource_ids = [r for r, entry in storage.iter_storage_files(str(tmp_path))]
+        assert resource_ids == ["abcdef-111", "abcdef-111"]
+
+    def test_write_variant(self, tmp_path):
+        content = b"a,b\n" * 1000
+        path = _create_resource_file(tmp_path, "abcdef-111", content)
+
+        assert storage.write_variant(path, "gzip")
+        assert storage.is_current_variant(path, "gzip")
+        with gzip.open(storage.variant_path(path, "gzip")) as f:
+            assert f.read() == content
+
+        # a new upload makes the variant outdated
+        os.utime(path, ns=(0, 0))
+        assert not storage.is_current_variant(path, "gzip")
+
+    def test_incompressible_file_has_no_variant(self, tmp_path):
+        path = _create_resource_file(tmp_path, "abcdef-111", os.urandom(1000))
+
+        assert not storage.write_variant(path, "gzip")
+        assert not os.path.exists(storage.variant_path(path, "gzip"))
+        assert not storage.is_current_variant(path, "gzip")
+
+
+class TestEnqueuePrecompress(object):
+    @pytest.fixture
+    def upload(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(uploader, "get_storage_path", lambda: str(tmp_path))
+        monkeypatch.setattr(jobs, "_s3filestore", False)
+        path = _create_resource_file(
+            tmp_path / "resources", "abcdef-111", b"a,b\n" * 1000
+        )
+        storage.write_variant(path, "gzip")
+        return path
+
+    def test_variants_are_removed_for_other_formats(self, upload):
+        jobs.enqueue_precompress(
+            {"id": "abcdef-111", "url_type": "upload", "format": "XLSX"}
+        )
+
+        assert os.path.exists(upload)
+        assert not os.path.exists(storage.variant_path(upload, "gzip"))
+
+    def test_variants_are_removed_for_links(self, upload):
+        jobs.enqueue_precompress(
+            {"id": "abcdef-111", "url": "http://example.com/velo.csv", "format": "CSV"}
+        )
+
+        assert not os.path.exists(storage.variant_path(upload, "gzip"))
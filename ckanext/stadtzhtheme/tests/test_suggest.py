@@ -0,0 +1,167 @@
+import threading
+import time
+
+import pysolr
+import pytest
+
+from ckanext.stadtzhtheme import suggest
+
+
+def _search_data(dataset_id, title, **kwargs):
+    search_data = {
+        "id": dataset_id,
+        "title": title,
+        "state": "active",
+        "groups": [],
+        "tags": [],
+        "license_id": "cc-zero",
+        "res_format": ["csv"],
+    }
+    search_data.update(kwargs)
+    return search_data
+
+
+class TestPrefixIndex(object):
+    def setup_method(self):
+        suggest.local_index.clear()
+        suggest.index_dataset(
+            _search_data("1", "Velofahrten Zählstellen", groups=["mobilitaet"])
+        )
+        suggest.index_dataset(
+            _search_data("2", "Anzahl Velos", groups=["mobilitaet"], tags=["velo"])
+        )
+        suggest.index_dataset(
+            _search_data("3", "Bevölkerung", groups=["bevolkerung"], state="deleted")
+        )
+
+    def test_prefix_search(self):
+        suggestions, complete = suggest.local_index.search("velo", "active")
+
+        assert [s["term"] for s in suggestions] == [
+            "Anzahl Velos",
+            "Velofahrten Zählstellen",
+            "velo",
+        ]
+        assert complete
+
+    def test_context_filter(self):
+        suggestions, complete = suggest.local_index.search(
+            "velo", "active AND mobilitaet AND velo"
+        )
+        assert [s["term"] for s in suggestions] == ["Anzahl Velos", "velo"]
+
+        suggestions, complete = suggest.local_index.search("bev", "active")
+        assert suggestions == []
+
+    def test_weight_counts_datasets(self):
+        suggestions, complete = suggest.local_index.search("mobil", "active")
+
+        assert suggestions == [{"term": "mobilitaet", "weight": 2}]
+
+    def test_update_and_remove(self):
+        suggest.index_dataset(_search_data("1", "Fussgänger", groups=["mobilitaet"]))
+        suggestions, complete = suggest.local_index.search("velofahrten", "active")
+        assert suggestions == []
+
+        suggest.local_index.remove("2")
+        suggestions, complete = suggest.local_index.search("velo", "active")
+        assert suggestions == []
+
+    def test_limit(self):
+        suggestions, complete = suggest.local_index.search("velo", "active", limit=2)
+
+        assert len(suggestions) == 2
+        assert not complete
+
+
+class TestLocalIndexRebuild(object):
+    def test_changes_during_rebuild_are_kept(self, monkeypatch):
+        def package_search(context, data_dict):
+            # datasets indexed or deleted by this process during the rebuild
+            suggest.index_dataset(_search_data("2", "Anzahl Velos"))
+            suggest.remove_dataset("1")
+            return {"count": 1, "results": [_search_data("1", "Velofahrten")]}
+
+        monkeypatch.setattr(suggest, "local_index", suggest.PrefixIndex())
+        monkeypatch.setattr(suggest.tk, "get_action", lambda name: package_search)
+
+        suggest.ensure_local_index()
+
+        suggestions, complete = suggest.local_index.search("velo", "active")
+        assert [s["term"] for s in suggestions] == ["Anzahl Velos"]
+
+    def test_stale_index_is_used_during_rebuild(self, monkeypatch):
+        started = threading.Event()
+        release = threading.Event()
+
+        def package_search(context, data_dict):
+            started.set()
+            release.wait(5)
+            return {"count": 0, "results": []}
+
+        stale = suggest.PrefixIndex()
+        stale.update("1", ["Velofahrten"], ["active"])
+        stale.built = time.monotonic() - 7200
+        monkeypatch.setattr(suggest, "local_index", stale)
+        monkeypatch.setattr(suggest.tk, "get_action", lambda name: package_search)
+        rebuild = threading.Thread(target=suggest.ensure_local_index)
+        rebuild.start()
+        started.wait(5)
+
+        # returns at once instead of waiting for the rebuild
+        suggest.ensure_local_index()
+        suggestions, complete = suggest.local_index.search("velo", "active")
+
+        release.set()
+        rebuild.join(5)
+        assert [s["term"] for s in suggestions] == ["Velofahrten"]
+        assert suggest.local_index is not stale
+
+
+class FakeSolr(object):
+    def __init__(self):
+        self.session = None
+        self.timeout = None
+        self.closed = False
+
+    def get_session(self):
+        return self
+
+    def close(self):
+        self.closed = True
+
+    def ping(self):
+        pass
+
+
+class TestSolrPool(object):
+    def setup_method(self):
+        self.created = []
+
+    def _make_connection(self):
+        client = FakeSolr()
+        self.created.append(client)
+        return client
+
+    def test_clients_are_reused(self, monkeypatch):
+        monkeypatch.setattr(suggest, "make_connection", self._make_connection)
+        pool = suggest.SolrPool(size=2, timeout=3)
+
+        with pool.connection() as first:
+            assert first.timeout == 3
+        with pool.connection() as second:
+            assert second is first
+        assert len(self.created) == 1
+
+    def test_failed_clients_are_discarded(self, monkeypatch):
+        monkeypatch.setattr(suggest, "make_connection", self._make_connection)
+        pool = suggest.SolrPool(size=2)
+
+        with pytest.raises(pysolr.SolrError):
+            with pool.connection():
+                raise pysolr.SolrError("Solr is down")
+        with pool.connection():
+            pass
+
+        assert len(self.created) == 2
+        assert self.created[0].closed